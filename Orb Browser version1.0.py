@@ -1,86 +1,1332 @@
 import os
 import sys
 import re
+import time
+import argparse
+import json
+import math
+import bisect
+import heapq
+import base64
+import collections
+import mmap
+import struct
+import zlib
+import marshal
+import hashlib
+import html
+import functools
+import inspect
 import asyncio
-import aiohttp
+import signal
+import queue
+import sqlite3
+import subprocess
 import threading
+import traceback
+import urllib.parse
+import uuid
 import xml.etree.ElementTree as ET
-from PySide6.QtCore import *
-from PySide6.QtWidgets import *
-from PySide6.QtGui import *
-from PySide6.QtWebEngineWidgets import *
-from PySide6.QtWebEngineCore import QWebEngineProfile
-from PySide6.QtCore import QTimer
-import yt_dlp
+from PySide6.QtCore import (QAbstractListModel, QBuffer, QByteArray, QDataStream, QIODevice, QModelIndex, QObject,
+                            QSortFilterProxyModel, QTimer, QUrl, Qt, Signal)
+from PySide6.QtWidgets import (QAbstractItemView, QApplication, QCheckBox, QComboBox, QCompleter, QDialog,
+                               QDockWidget, QFileDialog, QHBoxLayout, QHeaderView, QLabel, QLineEdit, QListView,
+                               QListWidget, QListWidgetItem, QMainWindow, QMenu, QProgressBar, QPushButton, QSpinBox,
+                               QStatusBar, QTabWidget, QTableWidget, QTableWidgetItem, QToolBar, QVBoxLayout, QWidget)
+from PySide6.QtGui import QAction, QColor, QIcon, QKeySequence, QPixmap, QShortcut, QStandardItem, QStandardItemModel
+from PySide6.QtWebEngineWidgets import QWebEngineView
+from PySide6.QtWebEngineCore import QWebEngineProfile, QWebEnginePage, QWebEngineDownloadRequest, QWebEngineUrlRequestInterceptor, QWebEngineUrlRequestInfo, QWebEngineScript, QWebEngineSettings
+# aiohttp と yt_dlp は読み込みに時間がかかるので、最初に使うときに import する
+
+
+class StartupTrace:
+    # プロセス開始から最初の描画までを段階ごとに記録する (--startup-trace で表示)
+    def __init__(self):
+        # None なら何も出さない。"-" なら表を表示し、それ以外はそのファイルに JSON で書く
+        self.output = None
+        self.exit_after_startup = False
+        now = time.perf_counter()
+        self.origin = now - self.process_age()
+        self.phases = [("interpreter + imports", now)]
+
+    @staticmethod
+    def process_age():
+        # /proc/self/stat の開始時刻 (起動からのクロック数) と /proc/uptime の差。精度は 10ms 程度
+        try:
+            with open("/proc/self/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/uptime") as f:
+                uptime = float(f.read().split()[0])
+            return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+        except (OSError, ValueError, IndexError):
+            return 0.0
+
+    def mark(self, phase):
+        self.phases.append((phase, time.perf_counter()))
+
+    def as_dict(self):
+        previous = self.origin
+        phases = []
+        for phase, at in self.phases:
+            phases.append({"phase": phase, "ms": (at - previous) * 1000, "total_ms": (at - self.origin) * 1000})
+            previous = at
+        return {"phases": phases, "total_ms": phases[-1]["total_ms"]}
+
+    def report(self):
+        if self.output is None:
+            return
+        if self.output != "-":
+            with open(self.output, "w", encoding="utf-8") as f:
+                json.dump(self.as_dict(), f, indent=1)
+            return
+        previous = self.origin
+        print(f"{'phase':<28}{'ms':>9}{'total ms':>11}")
+        for phase, at in self.phases:
+            print(f"{phase:<28}{(at - previous) * 1000:>9.1f}{(at - self.origin) * 1000:>11.1f}")
+            previous = at
+
+
+startup_trace = StartupTrace()
+
+FILTER_LISTS = [
+    "https://easylist.to/easylist/easylist.txt",
+    "https://easylist.to/easylist/easyprivacy.txt",
+]
+FILTER_REFRESH_INTERVAL = 6 * 60 * 60  # 6時間ごとに更新を確認
+
+MEMORY_SAVER_FREEZE_AFTER = 5 * 60
+MEMORY_SAVER_DISCARD_AFTER = 10 * 60
+MEMORY_SAVER_BUDGET_MB = 1024
+ESTIMATED_TAB_MEMORY_MB = 120
+TELEMETRY_INTERVAL_MS = 5000
+PERF_TRACE_EVENTS = 50000
+STALL_THRESHOLD_MS = 200
+WATCHDOG_HEARTBEAT_MS = 50
+
+PROFILE_NAME = "orb"
+PROFILE_DIR = "profile"
+HTTP_CACHE_MB = 256
+PRECONNECT_TOP_ORIGINS = 6
+PRECONNECT_TTL = 10.0  # Chromium は使われない先行接続をおよそ10秒で閉じる
+PRECONNECT_DELAY_MS = 120
+
+BOOKMARKS_DB = "bookmarks.db"
+FAVICON_DIR = "favicons"
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_MAX_MB = 512  # 圧縮後の合計の上限
+SNAPSHOT_ZSTD_LEVEL = 10
+SNAPSHOT_ZLIB_LEVEL = 6
+SNAPSHOT_LATENCY_SAMPLES = 100
+FAVICON_FETCH_WORKERS = 4
+
+SESSION_FILE = "session.json"
+SESSION_SAVE_DELAY_MS = 1000
+TAB_UPDATE_INTERVAL_MS = 16  # 約1フレーム
+
+DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "Downloads")
+MAX_CONCURRENT_DOWNLOADS = 3
+DOWNLOAD_REFRESH_MS = 250
+
+VIDEO_JOBS_FILE = "video_jobs.json"
+VIDEO_JOBS_KEPT = 100
+VIDEO_DOWNLOAD_WORKERS = 2
+VIDEO_FRAGMENT_CONCURRENCY = 4
+VIDEO_PROGRESS_MS = 250
+
+HOME_URL = "https://takerin-123.github.io/qqqqq.github.io/"
+URL_SCHEMES = {"http", "https", "file", "ftp", "about", "data", "chrome", "view-source", "qrc"}
+# 入力を URL とみなすのは、最後のラベルがここにあるトップレベルドメインのときだけ
+# (node.js や index.html のようなファイル名は検索に回す)
+COUNTRY_TLDS = set("""
+ac ad ae af ag ai al am ao aq ar as at au aw ax az ba bb bd be bf bg bh bi bj bm bn bo br bs bt bw by bz
+ca cc cd cf cg ch ci ck cl cm cn co cr cu cv cw cx cy cz de dj dk dm do dz ec ee eg er es et eu fi fj fk
+fm fo fr ga gd ge gf gg gh gi gl gm gn gp gq gr gs gt gu gw gy hk hm hn hr ht hu id ie il im in io iq ir
+is it je jm jo jp ke kg kh ki km kn kp kr kw ky kz la lb lc li lk lr ls lt lu lv ly ma mc md me mg mh mk
+ml mm mn mo mp mq mr ms mt mu mv mw mx my mz na nc ne nf ng ni nl no np nr nu nz om pa pe pf pg ph pk pl
+pm pn pr ps pt pw py qa re ro rs ru rw sa sb sc sd se sg sh si sk sl sm sn so sr ss st su sv sx sy sz tc
+td tf tg th tj tk tl tm tn to tr tt tv tw tz ua ug uk us uy uz va vc ve vg vi vn vu wf ws ye yt za zm zw
+""".split())
+GENERIC_TLDS = set("""
+com net org edu gov mil int arpa info biz name pro mobi asia tel travel jobs museum aero coop cat post
+app dev page blog shop store online site website tech space cloud xyz top club live news today world life
+email link click art design fun games video music photo studio network digital media agency solutions
+services company group global center social team tools wiki run host systems software cafe moe tokyo
+osaka nagoya yokohama kyoto okinawa
+""".split())
+# ファイルの拡張子としてよく使われる TLD は、パスやポートが付いていなければ URL とみなさない
+AMBIGUOUS_TLDS = {"md", "py", "sh", "rs", "pl", "zip", "mov"}
+OMNIBOX_SUGGESTIONS = 8
+OMNIBOX_CACHED_PREFIX = 3
+OMNIBOX_BLOCK = 64  # 索引を区切るブロックの大きさ (ブロックごとに最大スコアを持つ)
+OMNIBOX_TITLE_WORDS = 6
+OMNIBOX_BOOKMARK_WEIGHT = 4.0
+FRECENCY_HALF_LIFE = 30 * 24 * 60 * 60
+FRECENCY_EPOCH = 1700000000
+
+HISTORY_DB = "history.db"
+HISTORY_FLUSH_INTERVAL = 2.0
+HISTORY_FLUSH_BATCH = 200
+HISTORY_RETENTION_DAYS = 90
+HISTORY_OMNIBOX_ENTRIES = 100000
+
+FULLTEXT_DB = "fulltext.db"
+FULLTEXT_MAX_MB = 256  # 保存する本文の合計の上限
+FULLTEXT_MAX_CHARS = 100000  # 1ページから取り出す文字数の上限
+FULLTEXT_MAX_ELEMENTS = 50000  # これより要素の多い文書は取り出さない
+FULLTEXT_EXTRACT_INTERVAL_MS = 1000
+FULLTEXT_REINDEX_AFTER = 60 * 60
+FULLTEXT_RECENT_URLS = 2000
+FULLTEXT_QUEUE_LIMIT = 64
+FULLTEXT_TRIM_EVERY = 50
+FULLTEXT_RESULTS = 30
+
+DARK_MODE_SCRIPT = "orb-dark-mode"
+DARK_MODE_STYLE_ID = "orb-dark-mode-style"
+DARK_MODE_CSS = """
+:root { color-scheme: dark !important; }
+html, body { background-color: #121212 !important; color: #e0e0e0 !important; }
+a:link, a:visited { color: #8ab4f8 !important; }
+input, textarea, select, button { background-color: #1e1e1e !important; color: #e0e0e0 !important; border-color: #444 !important; }
+img, video, picture, canvas, svg, iframe { filter: none !important; }
+"""
+
+RESOURCE_TYPES = {
+    "script": 1,
+    "image": 2,
+    "stylesheet": 4,
+    "object": 8,
+    "xmlhttprequest": 16,
+    "subdocument": 32,
+    "font": 64,
+    "media": 128,
+    "websocket": 256,
+    "ping": 512,
+    "other": 1024,
+}
+ALL_RESOURCE_TYPES = sum(RESOURCE_TYPES.values())
+FILTER_OPTION_ALIASES = {
+    "xhr": "xmlhttprequest",
+    "css": "stylesheet",
+    "frame": "subdocument",
+    "3p": "third-party",
+    "1p": "first-party",
+}
+# ネットワークのブロックに関係しないので無視してよいオプション
+IGNORED_FILTER_OPTIONS = {"collapse", "~collapse"}
+# トークンとしてほとんど絞り込みにならない文字列
+COMMON_FILTER_TOKENS = {"http", "https", "www", "com", "net", "org", "js", "html"}
+FILTER_TOKEN_RE = re.compile(r"[a-z0-9%]{2,}")
+
+ADBLOCK_CACHE_DIR = "adblock_cache"
+FILTER_CACHE_MAGIC = b"ORBF"
+FILTER_CACHE_VERSION = 3
+# magic, version, digest, rule count, records, record offsets, end of file, crc32 of the body,
+# (domain table, domain slots, token table, token slots, generic start, generic count, rules) x 3
+_FILTER_HEADER = struct.Struct("<4sI20sIIIII21I")
+_FILTER_SLOT = struct.Struct("<III")
+_FILTER_RECORD = struct.Struct("<BIII")
+
+COSMETIC_CACHE_VERSION = 1
+COSMETIC_CHUNK = 1000  # 1つの規則にまとめるセレクタ数 (無効なセレクタが混ざると規則ごと捨てられる)
+COSMETIC_HOST_CACHE = 256
+COSMETIC_SCRIPT = "orb-cosmetic-generic"
+COSMETIC_SITE_SCRIPT = "orb-cosmetic-site"
+# CSS として解釈できない拡張構文 (スクリプトでの削除が必要になる)
+PROCEDURAL_SELECTOR_RE = re.compile(
+    r":-abp-|:has-text\(|:contains\(|:xpath\(|:matches-css|:upward\(|:remove\(|:style\(|"
+    r":min-text-length\(|:watch-attr\(|:matches-path\(|:others\(|:nth-ancestor\(")
+
+
+class _Span:
+    __slots__ = ("trace", "name", "category", "args", "start")
+
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.record(self.name, self.category, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class PerfTrace:
+    # 有効なときだけ区間の所要時間を環状バッファに貯め、Chrome の trace event 形式で書き出す
+    # (chrome://tracing や Perfetto で開ける)。無効なら span() は何もしない
+    def __init__(self, capacity=PERF_TRACE_EVENTS):
+        self.enabled = False
+        self.events = collections.deque(maxlen=capacity)
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def span(self, name, category="orb", **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def traced(self, name, category="orb"):
+        # メソッド全体を span で囲むデコレータ。Qt のシグナルは受け手が取れる分だけ引数を渡すので
+        # (triggered の checked など)、ラッパーも同じように余った位置引数を落としてから呼ぶ
+        def decorate(function):
+            params = inspect.signature(function).parameters.values()
+            if any(p.kind is p.VAR_POSITIONAL for p in params):
+                limit = None
+            else:
+                limit = sum(p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD) for p in params)
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    with self.span(name, category):
+                        return await function(*args[:limit], **kwargs)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    with self.span(name, category):
+                        return function(*args[:limit], **kwargs)
+            return wrapper
+        return decorate
+
+    def record(self, name, category, start, end, args=None, tid=None):
+        # deque.append はスレッドをまたいでも安全なので、裏のスレッドからも呼べる
+        self.events.append({
+            "name": name, "cat": category, "ph": "X", "pid": self.pid,
+            "tid": tid or threading.get_ident(),
+            "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+            "args": args or {},
+        })
+
+    def instant(self, name, category="orb", args=None, tid=None):
+        self.events.append({
+            "name": name, "cat": category, "ph": "i", "s": "t", "pid": self.pid,
+            "tid": tid or threading.get_ident(),
+            "ts": (time.perf_counter() - self.origin) * 1e6, "args": args or {},
+        })
+
+    def export(self, path):
+        names = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident, "args": {"name": thread.name}}
+                 for thread in threading.enumerate()]
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": names + list(self.events), "displayTimeUnit": "ms"}, f)
+        os.replace(path + ".tmp", path)
+
+
+perf_trace = PerfTrace()
+
+
+def _host_suffixes(host):
+    yield host
+    i = host.find(".")
+    while i != -1:
+        yield host[i + 1:]
+        i = host.find(".", i + 1)
+
+
+def _url_host(url):
+    start = url.find("://")
+    if start == -1:
+        return ""
+    start += 3
+    end = len(url)
+    for sep in "/?#":
+        i = url.find(sep, start)
+        if i != -1 and i < end:
+            end = i
+    host = url[start:end]
+    at = host.rfind("@")
+    if at != -1:
+        host = host[at + 1:]
+    if host.startswith("["):
+        return host[:host.find("]") + 1]
+    colon = host.find(":")
+    if colon != -1:
+        host = host[:colon]
+    return host
+
+
+def _base_domain(host):
+    parts = host.rsplit(".", 3)
+    # co.jp や co.uk のような二段階のトップレベルドメインを大まかに扱う
+    if len(parts) >= 3 and len(parts[-1]) == 2 and len(parts[-2]) <= 3:
+        return ".".join(parts[-3:])
+    return ".".join(parts[-2:])
+
+
+def _pattern_to_regex(pattern):
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return pattern[1:-1]
+    regex = ""
+    if pattern.startswith("||"):
+        regex = r"^[a-z][a-z0-9+.\-]*://(?:[^/?#]*\.)?"
+        pattern = pattern[2:]
+    elif pattern.startswith("|"):
+        regex = "^"
+        pattern = pattern[1:]
+    end = ""
+    if pattern.endswith("|"):
+        end = "$"
+        pattern = pattern[:-1]
+    parts = []
+    for ch in pattern:
+        if ch == "*":
+            if not parts or parts[-1] != ".*":
+                parts.append(".*")
+        elif ch == "^":
+            parts.append(r"(?:[^\w\-.%]|$)")
+        else:
+            parts.append(re.escape(ch))
+    return regex + "".join(parts) + end
+
+
+def _pattern_tokens(pattern):
+    # 前後がワイルドカードに接していないトークンだけが索引に使える
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return []
+    anchored_start = pattern.startswith("|")
+    body = pattern.lstrip("|")
+    anchored_end = body.endswith("|")
+    body = body.rstrip("|")
+    tokens = []
+    for match in FILTER_TOKEN_RE.finditer(body):
+        start, end = match.span()
+        if start == 0 and not anchored_start:
+            continue
+        if start > 0 and body[start - 1] == "*":
+            continue
+        if end == len(body) and not anchored_end:
+            continue
+        if end < len(body) and body[end] == "*":
+            continue
+        tokens.append(match.group())
+    return tokens
+
+
+class FilterRule:
+    __slots__ = ("pattern", "types", "third_party", "include_domains", "exclude_domains",
+                 "match_case", "important", "hostname", "_regex")
+
+    def __init__(self, pattern, types=ALL_RESOURCE_TYPES, third_party=None, include_domains=frozenset(),
+                 exclude_domains=frozenset(), match_case=False, important=False):
+        self.pattern = pattern
+        self.types = types
+        self.third_party = third_party
+        self.include_domains = include_domains
+        self.exclude_domains = exclude_domains
+        self.match_case = match_case
+        self.important = important
+        self.hostname = None
+        body = pattern[2:-1] if pattern.startswith("||") and pattern.endswith("^") else ""
+        if body and re.fullmatch(r"[a-z0-9.\-]+", body):
+            self.hostname = body
+        self._regex = None
+
+    @classmethod
+    def parse(cls, line):
+        options = ""
+        dollar = line.rfind("$")
+        if dollar != -1 and not (line.startswith("/") and line.endswith("/")):
+            line, options = line[:dollar], line[dollar + 1:]
+        types = 0
+        excluded_types = 0
+        third_party = None
+        include_domains = set()
+        exclude_domains = set()
+        match_case = False
+        important = False
+        for option in filter(None, options.split(",")):
+            option = option.strip().lower()
+            negated = option.startswith("~")
+            name = option.lstrip("~")
+            name = FILTER_OPTION_ALIASES.get(name, name)
+            if option in IGNORED_FILTER_OPTIONS:
+                continue
+            if name in RESOURCE_TYPES:
+                if negated:
+                    excluded_types |= RESOURCE_TYPES[name]
+                else:
+                    types |= RESOURCE_TYPES[name]
+            elif name == "third-party":
+                third_party = not negated
+            elif name == "first-party":
+                third_party = negated
+            elif name.startswith("domain="):
+                for domain in name[len("domain="):].split("|"):
+                    if domain.startswith("~"):
+                        exclude_domains.add(domain[1:])
+                    elif domain:
+                        include_domains.add(domain)
+            elif name == "match-case":
+                match_case = True
+            elif name == "important":
+                important = True
+            else:
+                # popup や csp など、リクエスト単位で扱えないルールは採用しない
+                return None
+        if types == 0:
+            types = ALL_RESOURCE_TYPES
+        types &= ~excluded_types
+        # 正規表現の本体は小文字にすると意味が変わる (\D → \d など) ので、そのまま残して
+        # 大文字小文字を無視してコンパイルする
+        if not match_case and not (line.startswith("/") and line.endswith("/")):
+            line = line.lower()
+        if not line or line in ("*", "|", "||"):
+            return None
+        return cls(line, types, third_party, frozenset(include_domains), frozenset(exclude_domains),
+                   match_case, important)
+
+    def regex(self):
+        if self._regex is None:
+            self._regex = re.compile(_pattern_to_regex(self.pattern), 0 if self.match_case else re.IGNORECASE)
+        return self._regex
+
+    def domain_allowed(self, first_party_host):
+        for suffix in _host_suffixes(first_party_host):
+            if suffix in self.exclude_domains:
+                return False
+            if suffix in self.include_domains:
+                return True
+        return not self.include_domains
+
+    def matches(self, url, lower_url, first_party_host, third_party, type_bit):
+        if not self.types & type_bit:
+            return False
+        if self.third_party is not None and self.third_party != third_party:
+            return False
+        if (self.include_domains or self.exclude_domains) and not self.domain_allowed(first_party_host):
+            return False
+        if self.hostname is not None:
+            # 索引のホスト名で既に一致している
+            return True
+        return self.regex().search(url if self.match_case else lower_url) is not None
+
+
+class FilterIndex:
+    def __init__(self):
+        self.domains = {}
+        self.tokens = {}
+        self.generic = []
+        self.rule_count = 0
+
+    def add(self, rule, token):
+        self.rule_count += 1
+        if rule.hostname is not None:
+            self.domains.setdefault(rule.hostname, []).append(rule)
+        elif token is not None:
+            self.tokens.setdefault(token, []).append(rule)
+        else:
+            self.generic.append(rule)
+
+    def match(self, url, lower_url, host, tokens, first_party_host, third_party, type_bit):
+        domains = self.domains
+        if domains:
+            for suffix in _host_suffixes(host):
+                rules = domains.get(suffix)
+                if rules is not None:
+                    for rule in rules:
+                        if rule.matches(url, lower_url, first_party_host, third_party, type_bit):
+                            return rule
+        index = self.tokens
+        for token in tokens:
+            rules = index.get(token)
+            if rules is not None:
+                for rule in rules:
+                    if rule.matches(url, lower_url, first_party_host, third_party, type_bit):
+                        return rule
+        for rule in self.generic:
+            if rule.matches(url, lower_url, first_party_host, third_party, type_bit):
+                return rule
+        return None
+
+
+class MappedFilterIndex:
+    def __init__(self, data, domain_table, domain_slots, token_table, token_slots, generic_start, generic_count, rule_count):
+        self.data = data
+        self.domain_table = domain_table
+        self.domain_slots = domain_slots
+        self.token_table = token_table
+        self.token_slots = token_slots
+        self.generic = range(generic_start, generic_start + generic_count)
+        self.rule_count = rule_count
+
+    def _lookup(self, table, slots, key):
+        h = zlib.crc32(key.encode())
+        mask = slots - 1
+        i = h & mask
+        buf = self.data.buf
+        while True:
+            slot_hash, start, count = _FILTER_SLOT.unpack_from(buf, table + i * _FILTER_SLOT.size)
+            if count == 0:
+                return ()
+            if slot_hash == h:
+                return range(start, start + count)
+            i = (i + 1) & mask
+
+    def match(self, url, lower_url, host, tokens, first_party_host, third_party, type_bit):
+        data = self.data
+        for suffix in _host_suffixes(host):
+            for rule_id in self._lookup(self.domain_table, self.domain_slots, suffix):
+                rule = data.rule(rule_id)
+                # crc32 の衝突もあり得るので、ホスト名そのものを確認する
+                if rule.hostname == suffix and rule.matches(url, lower_url, first_party_host, third_party, type_bit):
+                    return rule
+        for token in tokens:
+            for rule_id in self._lookup(self.token_table, self.token_slots, token):
+                rule = data.rule(rule_id)
+                if rule.matches(url, lower_url, first_party_host, third_party, type_bit):
+                    return rule
+        for rule_id in self.generic:
+            rule = data.rule(rule_id)
+            if rule.matches(url, lower_url, first_party_host, third_party, type_bit):
+                return rule
+        return None
+
+
+class MappedFilterData:
+    def __init__(self, path, digest):
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _FILTER_HEADER.unpack_from(self.buf, 0)
+        magic, version, file_digest, rule_count, records, record_offsets, end, checksum = header[:8]
+        if magic != FILTER_CACHE_MAGIC or version != FILTER_CACHE_VERSION:
+            raise ValueError("unknown filter cache format")
+        if file_digest != digest:
+            raise ValueError("filter cache is stale")
+        if sys.byteorder != "little":
+            raise ValueError("filter cache requires a little-endian host")
+        if end != len(self.buf):
+            raise ValueError("filter cache is truncated")
+        # 本文が壊れていると interceptRequest の中で初めて失敗するので、読み込み時に確かめる
+        if zlib.crc32(memoryview(self.buf)[_FILTER_HEADER.size:]) != checksum:
+            raise ValueError("filter cache checksum mismatch")
+        self.records = records
+        self.record_offsets = memoryview(self.buf)[record_offsets:record_offsets + rule_count * 4].cast("I")
+        self.header = header[8:]
+        self.rules = {}
+
+    def rule(self, rule_id):
+        rule = self.rules.get(rule_id)
+        if rule is None:
+            offset = self.records + self.record_offsets[rule_id]
+            flags, types, pattern_length, domains_length = _FILTER_RECORD.unpack_from(self.buf, offset)
+            offset += _FILTER_RECORD.size
+            pattern = self.buf[offset:offset + pattern_length].decode()
+            domains = self.buf[offset + pattern_length:offset + pattern_length + domains_length].decode()
+            include_domains = frozenset(d for d in domains.split("|") if d and not d.startswith("~"))
+            exclude_domains = frozenset(d[1:] for d in domains.split("|") if d.startswith("~"))
+            third_party = bool(flags & 2) if flags & 1 else None
+            rule = FilterRule(pattern, types, third_party, include_domains, exclude_domains,
+                              bool(flags & 4), bool(flags & 8))
+            self.rules[rule_id] = rule
+        return rule
+
+
+class AdblockFilter:
+    def __init__(self, blocking=None, exceptions=None, important=None):
+        self.blocking = blocking if blocking is not None else FilterIndex()
+        self.exceptions = exceptions if exceptions is not None else FilterIndex()
+        # $important は例外より優先されるので、通常の規則とは別の索引で先に引く
+        self.important = important if important is not None else FilterIndex()
+
+    @property
+    def rule_count(self):
+        return self.blocking.rule_count + self.exceptions.rule_count + self.important.rule_count
+
+    def compile(self, lines):
+        parsed = []
+        token_counts = {}
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(("!", "[")) or "##" in line or "#@#" in line or "#?#" in line:
+                continue
+            exception = line.startswith("@@")
+            rule = FilterRule.parse(line[2:] if exception else line)
+            if rule is None:
+                continue
+            tokens = [] if rule.hostname is not None or rule.match_case else _pattern_tokens(rule.pattern)
+            for token in tokens:
+                token_counts[token] = token_counts.get(token, 0) + 1
+            parsed.append((exception, rule, tokens))
+        # 最も出現頻度の低いトークンにルールを割り当て、各バケツを小さく保つ
+        for exception, rule, tokens in parsed:
+            token = None
+            if tokens:
+                token = min(tokens, key=lambda t: (t in COMMON_FILTER_TOKENS, token_counts[t], -len(t)))
+            if exception:
+                self.exceptions.add(rule, token)
+            elif rule.important:
+                self.important.add(rule, token)
+            else:
+                self.blocking.add(rule, token)
+        return self
+
+    @classmethod
+    def load(cls, path, digest):
+        data = MappedFilterData(path, digest)
+        h = data.header
+        return cls(MappedFilterIndex(data, *h[:7]), MappedFilterIndex(data, *h[7:14]), MappedFilterIndex(data, *h[14:]))
+
+    def save(self, path, digest):
+        # 次回起動時に mmap でそのまま引けるよう、ハッシュ表と規則を平らなバイナリにする
+        # 規則はバケツ順に並べるので、各スロットは規則番号の範囲 (start, count) を指すだけでよい
+        rules = []
+        tables = []
+        fields = []
+        table_offset = _FILTER_HEADER.size
+        for index in (self.blocking, self.exceptions, self.important):
+            for buckets in (index.domains, index.tokens):
+                by_hash = {}
+                for key, bucket in buckets.items():
+                    # 同じ crc32 のキーは一つのバケツにまとめる (照合時に再確認する)
+                    by_hash.setdefault(zlib.crc32(key.encode()), []).extend(bucket)
+                slots = 1 << max(1, (len(by_hash) * 2).bit_length())
+                table = [(0, 0, 0)] * slots
+                for h, bucket in by_hash.items():
+                    i = h & (slots - 1)
+                    while table[i][2]:
+                        i = (i + 1) & (slots - 1)
+                    table[i] = (h, len(rules), len(bucket))
+                    rules.extend(bucket)
+                tables.append(b"".join(_FILTER_SLOT.pack(*slot) for slot in table))
+                fields += [table_offset, slots]
+                table_offset += len(tables[-1])
+            fields += [len(rules), len(index.generic), index.rule_count]
+            rules.extend(index.generic)
+        records = []
+        record_offsets = []
+        size = 0
+        for rule in rules:
+            pattern = rule.pattern.encode()
+            domains = "|".join([*rule.include_domains, *("~" + d for d in rule.exclude_domains)]).encode()
+            flags = ((rule.third_party is not None) | (bool(rule.third_party) << 1)
+                     | (rule.match_case << 2) | (rule.important << 3))
+            record = _FILTER_RECORD.pack(flags, rule.types, len(pattern), len(domains)) + pattern + domains
+            record_offsets.append(size)
+            records.append(record)
+            size += len(record)
+        record_offsets_offset = table_offset
+        records_offset = record_offsets_offset + 4 * len(rules)
+        body = b"".join(tables) + struct.pack(f"<{len(rules)}I", *record_offsets) + b"".join(records)
+        header = _FILTER_HEADER.pack(FILTER_CACHE_MAGIC, FILTER_CACHE_VERSION, digest, len(rules),
+                                     records_offset, record_offsets_offset, records_offset + size,
+                                     zlib.crc32(body), *fields)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def should_block(self, url, first_party_url="", resource_type="other"):
+        lower_url = url.lower()
+        host = _url_host(lower_url)
+        if not host:
+            return False
+        first_party_host = _url_host(first_party_url.lower()) if first_party_url else host
+        third_party = _base_domain(host) != _base_domain(first_party_host or host)
+        type_bit = RESOURCE_TYPES.get(resource_type, RESOURCE_TYPES["other"])
+        tokens = FILTER_TOKEN_RE.findall(lower_url)
+        if self.important.match(url, lower_url, host, tokens, first_party_host, third_party, type_bit) is not None:
+            return True
+        if self.blocking.match(url, lower_url, host, tokens, first_party_host, third_party, type_bit) is None:
+            return False
+        return self.exceptions.match(url, lower_url, host, tokens, first_party_host, third_party, type_bit) is None
+
+
+def benchmark_filter_matching(list_paths, corpus_path, repeat=3):
+    lines = []
+    for path in list_paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines.extend(f.read().splitlines())
+    start = time.perf_counter()
+    engine = AdblockFilter().compile(lines)
+    compile_seconds = time.perf_counter() - start
+    cosmetic = CosmeticFilter().compile(lines)
+    corpus = []
+    with open(corpus_path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0]:
+                corpus.append((fields[0], fields[1] if len(fields) > 1 else "", fields[2] if len(fields) > 2 else "other"))
+    if not corpus:
+        raise ValueError(f"URL corpus is empty: {corpus_path}")
+    best = None
+    blocked = 0
+    for _ in range(repeat):
+        blocked = 0
+        start = time.perf_counter()
+        for url, first_party_url, resource_type in corpus:
+            if engine.should_block(url, first_party_url, resource_type):
+                blocked += 1
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = {
+        "rules": engine.rule_count,
+        "compile_seconds": compile_seconds,
+        "urls": len(corpus),
+        "blocked": blocked,
+        "matches_per_second": len(corpus) / best if best else float("inf"),
+        "microseconds_per_match": best / len(corpus) * 1e6,
+        "cosmetic_rules": cosmetic.rule_count,
+        "cosmetic_skipped": cosmetic.skipped,
+        "generic_css_bytes": len(cosmetic.generic_stylesheet()),
+    }
+    print(f"rules: {result['rules']}  compile: {compile_seconds * 1000:.1f} ms")
+    print(f"urls: {result['urls']}  blocked: {blocked}")
+    print(f"{result['matches_per_second']:.0f} matches/s  ({result['microseconds_per_match']:.2f} us/match)")
+    print(f"cosmetic: {result['cosmetic_rules']} selectors ({result['cosmetic_skipped']} skipped)  "
+          f"generic css: {result['generic_css_bytes'] / 1024:.0f} KiB")
+    return result
+
+
+def _selector_is_cheap(selector):
+    # ブラウザはセレクタの右端の複合セレクタの id / class で規則を振り分けるので、
+    # それを持たない汎用セレクタはすべての要素で評価されてスタイル再計算を重くする
+    compound = re.split(r"[\s>+~]+", re.sub(r"\[[^\]]*\]|\([^)]*\)", "", selector).strip())[-1]
+    return re.search(r"[#.][\w-]", compound) is not None
+
+
+def _hiding_stylesheet(selectors):
+    return "\n".join(",".join(selectors[i:i + COSMETIC_CHUNK]) + "{display:none!important}"
+                     for i in range(0, len(selectors), COSMETIC_CHUNK))
+
+
+class CosmeticFilter:
+    def __init__(self, generic=(), domains=None, exceptions=None, generic_hide=(), element_hide=()):
+        self.generic = list(generic)
+        self.domains = domains if domains is not None else {}
+        self.exceptions = exceptions if exceptions is not None else {}
+        self.generic_hide = set(generic_hide)
+        self.element_hide = set(element_hide)
+        generic = set(self.generic)
+        # 汎用セレクタを例外にしているホスト。共通のスタイルシートはそのまま使い、
+        # 例外になったセレクタの規則だけをそのページで取り除く
+        self.generic_exceptions = {host: generic.intersection(selectors) for host, selectors in self.exceptions.items()
+                                   if not generic.isdisjoint(selectors)}
+        self.excepted_generic = sorted(set().union(*self.generic_exceptions.values()))
+        self.skipped = 0
+        self.host_css = collections.OrderedDict()
+
+    @property
+    def rule_count(self):
+        return len(self.generic) + sum(len(selectors) for selectors in self.domains.values())
+
+    def compile(self, lines):
+        generic = set()
+        generic_exceptions = set()
+        domains = {}
+        exceptions = {}
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(("!", "[")):
+                continue
+            if line.startswith("@@||") and "$" in line:
+                pattern, options = line[4:].rsplit("$", 1)
+                host = pattern.rstrip("^/")
+                options = {option.strip().lower() for option in options.split(",")}
+                if re.fullmatch(r"[a-z0-9.\-]+", host):
+                    if options & {"elemhide", "ehide"}:
+                        self.element_hide.add(host)
+                    if options & {"generichide", "ghide"}:
+                        self.generic_hide.add(host)
+                continue
+            if re.search(r"#@?[?$%]#", line):
+                continue
+            if "#@#" in line:
+                sites, selector = line.split("#@#", 1)
+                exception = True
+            elif "##" in line:
+                sites, selector = line.split("##", 1)
+                exception = False
+            else:
+                continue
+            selector = selector.strip()
+            if not selector or PROCEDURAL_SELECTOR_RE.search(selector):
+                self.skipped += 1
+                continue
+            included = [site.strip().lower() for site in sites.split(",") if site.strip() and not site.strip().startswith("~")]
+            excluded = [site.strip().lower()[1:] for site in sites.split(",") if site.strip().startswith("~")]
+            if exception:
+                if not included:
+                    generic_exceptions.add(selector)
+                for site in included:
+                    exceptions.setdefault(site, set()).add(selector)
+                continue
+            for site in excluded:
+                exceptions.setdefault(site, set()).add(selector)
+            if included:
+                for site in included:
+                    domains.setdefault(site, set()).add(selector)
+            elif _selector_is_cheap(selector):
+                generic.add(selector)
+            else:
+                self.skipped += 1
+        skipped = self.skipped
+        self.__init__(sorted(generic - generic_exceptions),
+                      {site: sorted(selectors - generic_exceptions) for site, selectors in domains.items()},
+                      {site: sorted(selectors) for site, selectors in exceptions.items()},
+                      self.generic_hide, self.element_hide)
+        self.skipped = skipped
+        return self
+
+    def generic_stylesheet(self):
+        # どこかのホストで例外になっているセレクタは一つずつ別の規則にし、番号を付けておく
+        excepted = set(self.excepted_generic)
+        css = _hiding_stylesheet([selector for selector in self.generic if selector not in excepted])
+        tagged = "\n".join(f"{selector}{{display:none!important;--orb-exception:{i}}}"
+                           for i, selector in enumerate(self.excepted_generic))
+        return css + "\n" + tagged if css and tagged else css or tagged
+
+    def generic_unhidden(self):
+        ids = {selector: i for i, selector in enumerate(self.excepted_generic)}
+        return {host: sorted(ids[selector] for selector in selectors)
+                for host, selectors in self.generic_exceptions.items()}
+
+    def generic_skip_hosts(self):
+        return self.generic_hide | self.element_hide
+
+    def css_for_host(self, host):
+        # ページ単位で差し込むのはそのドメイン向けのセレクタだけ。汎用分はプロファイルの
+        # 共通スクリプトが受け持ち、ここには決して複製しない
+        css = self.host_css.get(host)
+        if css is not None:
+            self.host_css.move_to_end(host)
+            return css
+        selectors = set()
+        excluded = set()
+        for suffix in _host_suffixes(host):
+            if suffix in self.element_hide:
+                selectors.clear()
+                break
+            selectors.update(self.domains.get(suffix, ()))
+            excluded.update(self.exceptions.get(suffix, ()))
+        css = _hiding_stylesheet(sorted(selectors - excluded))
+        self.host_css[host] = css
+        if len(self.host_css) > COSMETIC_HOST_CACHE:
+            self.host_css.popitem(last=False)
+        return css
+
+    @classmethod
+    def load(cls, path, digest):
+        with open(path, "rb") as f:
+            version, saved_digest, generic, domains, exceptions, generic_hide, element_hide = marshal.load(f)
+        if version != COSMETIC_CACHE_VERSION or saved_digest != digest:
+            raise ValueError("stale cosmetic filter cache")
+        return cls(generic, domains, exceptions, generic_hide, element_hide)
+
+    def save(self, path, digest):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            marshal.dump((COSMETIC_CACHE_VERSION, digest, self.generic, self.domains, self.exceptions,
+                          sorted(self.generic_hide), sorted(self.element_hide)), f)
+        os.replace(tmp_path, path)
+
+
+class AdblockInterceptor(QWebEngineUrlRequestInterceptor):
+    RESOURCE_TYPE_NAMES = {
+        "ResourceTypeMainFrame": "document",
+        "ResourceTypeSubFrame": "subdocument",
+        "ResourceTypeStylesheet": "stylesheet",
+        "ResourceTypeScript": "script",
+        "ResourceTypeImage": "image",
+        "ResourceTypeFontResource": "font",
+        "ResourceTypeSubResource": "other",
+        "ResourceTypeObject": "object",
+        "ResourceTypeMedia": "media",
+        "ResourceTypeWorker": "script",
+        "ResourceTypeSharedWorker": "script",
+        "ResourceTypePrefetch": "other",
+        "ResourceTypeFavicon": "image",
+        "ResourceTypeXhr": "xmlhttprequest",
+        "ResourceTypePing": "ping",
+        "ResourceTypeServiceWorker": "script",
+        "ResourceTypeCspReport": "other",
+        "ResourceTypePluginResource": "object",
+        "ResourceTypeNavigationPreloadMainFrame": "document",
+        "ResourceTypeNavigationPreloadSubFrame": "subdocument",
+        "ResourceTypeWebSocket": "websocket",
+    }
+
+    def __init__(self, adblock, parent=None):
+        super().__init__(parent)
+        self.adblock = adblock
+        self.record_file = None
+        resource_type = QWebEngineUrlRequestInfo.ResourceType
+        self.resource_types = {getattr(resource_type, name): kind
+                               for name, kind in self.RESOURCE_TYPE_NAMES.items() if hasattr(resource_type, name)}
+
+    def interceptRequest(self, info):
+        url = info.requestUrl().toString()
+        if not url.startswith(("http:", "https:", "ws:", "wss:")):
+            return
+        first_party_url = info.firstPartyUrl().toString()
+        resource_type = self.resource_types.get(info.resourceType(), "other")
+        if self.record_file is not None:
+            self.record_file.write(f"{url}\t{first_party_url}\t{resource_type}\n")
+        if resource_type == "document":
+            return
+        if self.adblock.engine.should_block(url, first_party_url, resource_type):
+            info.block(True)
+
+
+class AsyncRunner(QObject):
+    # asyncio のループを専用スレッドで回し、結果は Qt のシグナル経由で GUI スレッドに返す
+    finished = Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.finished.connect(self.deliver)
+        self.thread = threading.Thread(target=self.run, name="orb-asyncio", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def submit(self, coro, callback=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback is not None:
+            future.add_done_callback(lambda f, callback=callback: self.finished.emit(callback, f))
+        return future
+
+    def deliver(self, callback, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"An error occurred: {future.exception()}")
+            return
+        callback(future.result())
+
+    def call_periodically(self, interval, coro_function):
+        async def repeat():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await coro_function()
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+        return self.submit(repeat())
+
+    async def get_session(self):
+        # すべてのバックグラウンド通信で一つのコネクションプールを共有する
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=120),
+            )
+        return self.session
+
+    async def close(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def shutdown(self, timeout=5):
+        if not self.thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.close(), self.loop).result(timeout)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+class CosmeticInjector(QObject):
+    # 別スレッドで読み込んだ・作り直したフィルタを GUI スレッドでプロファイルに反映する
+    changed = Signal(object)
+
+    def __init__(self, profile):
+        super().__init__()
+        self.profile = profile
+        self.cosmetic = CosmeticFilter()
+        self.generation = 0
+        self.changed.connect(self.install)
+
+    def install(self, cosmetic):
+        self.cosmetic = cosmetic
+        self.generation += 1
+        scripts = self.profile.scripts()
+        for script in scripts.find(COSMETIC_SCRIPT):
+            scripts.remove(script)
+        if cosmetic.generic:
+            script = QWebEngineScript()
+            script.setName(COSMETIC_SCRIPT)
+            script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+            script.setWorldId(QWebEngineScript.ApplicationWorld)
+            script.setRunsOnSubFrames(True)
+            script.setSourceCode(style_injection_js(COSMETIC_SCRIPT, cosmetic.generic_stylesheet(),
+                                                    cosmetic.generic_skip_hosts(), cosmetic.generic_unhidden()))
+            scripts.insert(script)
+
+    def apply(self, page, url):
+        host = url.host().lower()
+        key = f"{self.generation}:{host}"
+        if page.property("cosmeticKey") == key:
+            return
+        page.setProperty("cosmeticKey", key)
+        scripts = page.scripts()
+        for script in scripts.find(COSMETIC_SITE_SCRIPT):
+            scripts.remove(script)
+        css = self.cosmetic.css_for_host(host) if host else ""
+        if not css:
+            return
+        script = QWebEngineScript()
+        script.setName(COSMETIC_SITE_SCRIPT)
+        script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+        script.setWorldId(QWebEngineScript.ApplicationWorld)
+        script.setRunsOnSubFrames(False)
+        script.setSourceCode(style_injection_js(COSMETIC_SITE_SCRIPT, css))
+        scripts.insert(script)
+
+
+class OrbPage(QWebEnginePage):
+    def __init__(self, profile, cosmetics, parent=None):
+        super().__init__(profile, parent)
+        self.cosmetics = cosmetics
+
+    def acceptNavigationRequest(self, url, navigation_type, is_main_frame):
+        # 遷移先のドキュメントが作られる前にそのドメイン向けのスタイルシートを用意しておく
+        if is_main_frame:
+            self.cosmetics.apply(self, url)
+        return super().acceptNavigationRequest(url, navigation_type, is_main_frame)
+
 
 class AdblockX:
-    def __init__(self, page, adBlocker):
-        self.page = page
-        self.block_lists = []
-        self.tracker_lists = []
-        self.adBlocker = adBlocker
-        self.session = aiohttp.ClientSession()
+    def __init__(self, profile, runner, cache_dir=ADBLOCK_CACHE_DIR):
+        self.profile = profile
+        self.runner = runner
+        self.cache_dir = cache_dir
+        self.compiled_path = os.path.join(cache_dir, "filters.bin")
+        self.cosmetic_path = os.path.join(cache_dir, "cosmetic.bin")
+        self.engine = AdblockFilter()
+        self.cosmetics = CosmeticInjector(profile)
+        self.cache_digest = None
+        self.rebuild_lock = threading.Lock()
+        self.interceptor = AdblockInterceptor(self)
+        self.profile.setUrlRequestInterceptor(self.interceptor)
+        self.load_cache()
 
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.session.close()
+    def list_path(self, url):
+        return os.path.join(self.cache_dir, url.rsplit("/", 1)[-1])
 
+    def read_meta(self, url):
+        try:
+            with open(self.list_path(url) + ".json", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def lists_digest(self):
+        digest = hashlib.sha1()
+        for url in FILTER_LISTS:
+            meta = self.read_meta(url)
+            if "sha1" not in meta:
+                return None
+            digest.update(meta["sha1"].encode())
+        return digest.digest()
+
+    @perf_trace.traced("filter cache load", "filters")
+    def load_cache(self):
+        digest = self.lists_digest()
+        if digest is None:
+            return
+        try:
+            self.engine = AdblockFilter.load(self.compiled_path, digest)
+            self.cache_digest = digest
+        except (OSError, ValueError, struct.error) as e:
+            # 壊れた・古いキャッシュは最初のページ読み込みを待たせずに作り直す
+            print(f"Rebuilding filter cache: {e}")
+            threading.Thread(target=self.rebuild_cache, daemon=True).start()
+            return
+        # 要素隠しのセレクタは数 MB になるので、読み込みは起動の邪魔をしないよう裏で行う
+        threading.Thread(target=self.load_cosmetic_cache, args=(digest,), daemon=True).start()
+
+    def load_cosmetic_cache(self, digest):
+        try:
+            cosmetic = CosmeticFilter.load(self.cosmetic_path, digest)
+        except (OSError, ValueError, EOFError, TypeError) as e:
+            print(f"Rebuilding filter cache: {e}")
+            self.rebuild_cache(force=True)
+            return
+        self.cosmetics.changed.emit(cosmetic)
+
+    @perf_trace.traced("filter compile", "filters")
+    def rebuild_cache(self, force=False):
+        with self.rebuild_lock:
+            digest = self.lists_digest()
+            if digest is None or (digest == self.cache_digest and not force):
+                return
+            lines = []
+            for url in FILTER_LISTS:
+                with open(self.list_path(url), encoding="utf-8", errors="replace") as f:
+                    lines.extend(f.read().splitlines())
+            engine = AdblockFilter().compile(lines)
+            self.engine = engine
+            cosmetic = CosmeticFilter().compile(lines)
+            self.cosmetics.changed.emit(cosmetic)
+            try:
+                engine.save(self.compiled_path, digest)
+                self.engine = AdblockFilter.load(self.compiled_path, digest)
+                cosmetic.save(self.cosmetic_path, digest)
+            except (OSError, ValueError) as e:
+                print(f"An error occurred: {e}")
+            self.cache_digest = digest
+
+    @perf_trace.traced("filter list fetch", "filters")
     async def fetch_lists(self, url):
+        session = await self.runner.get_session()
+        path = self.list_path(url)
+        meta = self.read_meta(url)
+        headers = {}
+        if os.path.exists(path):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
         try:
-            async with self.session.get(url) as response:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return False
                 if response.status != 200:
                     raise Exception(f"Failed to fetch lists: {response.status}")
-                return (await response.text()).split('\n')
+                body = await response.read()
+                meta = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha1": hashlib.sha1(body).hexdigest(),
+                }
         except Exception as e:
             print(f"An error occurred: {e}")
-            return []
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(body)
+        os.replace(path + ".tmp", path)
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        return True
 
     async def update_lists(self):
-        block_lists, tracker_lists = await asyncio.gather(
-            self.fetch_lists("https://easylist.to/easylist/easylist.txt"),
-            self.fetch_lists("https://easylist.to/easylist/easyprivacy.txt")
-        )
-        if block_lists and block_lists != self.block_lists:
-            self.block_lists = block_lists
-            await self.blockAds()
-        if tracker_lists and tracker_lists != self.tracker_lists:
-            self.tracker_lists = tracker_lists
-            await self.blockTrackers()
-
-    async def blockAds(self):
-        await self.adBlocker.setUrlFilterRules(self.block_lists)
-
-    async def blockTrackers(self):
-        await self.adBlocker.setUrlFilterRules(self.tracker_lists)
+        await asyncio.gather(*(self.fetch_lists(url) for url in FILTER_LISTS))
+        if self.lists_digest() != self.cache_digest:
+            # 10万行規模のコンパイルはイベントループを止めないように別スレッドで行う
+            await asyncio.get_running_loop().run_in_executor(None, self.rebuild_cache)
 
     async def main(self):
         await self.update_lists()
 
-    async def updateBlockedContent(self, event):
+    async def updateBlockedContent(self, event=None):
         await self.update_lists()
 
 class MainWindow(QMainWindow):
+    home_url = HOME_URL
+
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         self.language = "日本語"
+        self.first_painted = False
+        self.background_started = False
         self.tabs = QTabWidget()
+        self.profile = create_profile()
         self.memory_saver = MemorySaver(self.tabs)
-        self.dark_mode = DarkMode(self.tabs)
+        self.dark_mode = DarkMode(self.tabs, self.profile)
+        self.async_runner = AsyncRunner()
+        QApplication.instance().aboutToQuit.connect(self.async_runner.shutdown)
+        self.adblock = AdblockX(self.profile, self.async_runner)
+        startup_trace.mark("filter cache")
+        self.bookmarks = BookmarkStore()
+        self.omnibox = OmniboxIndex()
+        self.history = HistoryStore()
+        self.history.loaded.connect(self.history_loaded)
+        self.favicons = FaviconCache(self.async_runner)
+        self.favicons.iconReady.connect(self.update_bookmark_icons)
+        self.snapshots = SnapshotStore(self.profile, self.async_runner)
+        self.snapshots.saved.connect(self.snapshot_saved)
+        self.snapshots.stale.connect(self.snapshot_stale)
+        self.preconnector = Preconnector(self.profile, self.tabs)
+        self.fulltext = FullTextIndex()
+        self.text_extractor = PageTextExtractor(self.fulltext)
+        startup_trace.mark("stores")
         self.load_settings()
         self.init_ui()
 
+    def start_background_services(self):
+        # 最初の描画までに要らないもの (通信・履歴の読み込み・動画キュー) はここで始める
+        if self.background_started:
+            return
+        self.background_started = True
+        self.async_runner.submit(self.adblock.main())
+        self.async_runner.call_periodically(FILTER_REFRESH_INTERVAL, self.adblock.updateBlockedContent)
+        self.history.start()
+        QApplication.instance().aboutToQuit.connect(self.history.close)
+        self.favicons.start()
+        self.fulltext.start()
+        QApplication.instance().aboutToQuit.connect(self.fulltext.close)
+        self.video_downloads = VideoDownloadQueue()
+        QApplication.instance().aboutToQuit.connect(self.video_downloads.shutdown)
+        self.download_panel = DownloadPanel(self, self.downloads, self.video_downloads)
+        self.addDockWidget(Qt.DockWidgetArea.BottomDockWidgetArea, self.download_panel)
+        self.download_panel.hide()
+        startup_trace.mark("background services")
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.first_painted:
+            self.first_painted = True
+            startup_trace.mark("first paint")
+            startup_trace.report()
+            if startup_trace.exit_after_startup:
+                QTimer.singleShot(0, QApplication.instance().quit)
+            else:
+                QTimer.singleShot(0, self.start_background_services)
+
     def init_ui(self):
-        self.tabs = QTabWidget()
         self.tabs.setDocumentMode(True)
         self.tabs.tabBarDoubleClicked.connect(self.tab_open_doubleclick)
         self.tabs.currentChanged.connect(self.current_tab_changed)
         self.tabs.setTabsClosable(True)
-        self.memory_saver = MemorySaver(self.tabs)
-        self.dark_mode = DarkMode(self.tabs)
+        self.telemetry = TabTelemetry(self.tabs)
+        self.memory_saver.telemetry = self.telemetry
+        self.session = SessionStore(self.tabs)
+        QApplication.instance().aboutToQuit.connect(self.session.save)
+        self.tab_registry = TabRegistry(self.tabs)
+        self.tab_registry.updated.connect(self.tabs_updated)
+        self.tab_registry.closed.connect(self.session.forget)
+        self.tab_registry.closed.connect(self.memory_saver.forget)
+        self.tab_registry.closed.connect(self.text_extractor.forget)
+        self.tab_registry.closed.connect(self.preconnector.forget)
         self.add_tab_button = QPushButton("")
         self.add_tab_button.setStyleSheet("background-color: black; color: black;")
         self.add_tab_button.clicked.connect(self.add_new_tab)
         self.vertical_bar = QToolBar("Vertical Bar")
         self.vertical_bar.setOrientation(Qt.Orientation.Vertical)
+        self.vertical_bar.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.vertical_bar.customContextMenuRequested.connect(self.show_bookmark_menu)
         self.addToolBar(Qt.ToolBarArea.LeftToolBarArea, self.vertical_bar)
         self.tabs.setCornerWidget(self.add_tab_button, Qt.TopRightCorner)
         self.tabs.tabCloseRequested.connect(self.close_current_tab)
@@ -90,6 +1336,7 @@ class MainWindow(QMainWindow):
         navtb = QToolBar("Navigation")
         self.addToolBar(navtb)
         self.load_shortcuts()
+        startup_trace.mark("bookmarks")
         back_btn = QAction("↩︎", self)
         back_btn.setStatusTip("Back to previous page")
         back_btn.triggered.connect(lambda: self.tabs.currentWidget().back())
@@ -110,6 +1357,10 @@ class MainWindow(QMainWindow):
         self.star_button.setStatusTip("Add shortcut to vertical bar")
         self.star_button.triggered.connect(self.add_shortcut)
         self.toolbar.addAction(self.star_button)
+        snapshot_btn = QAction("💾", self)
+        snapshot_btn.setStatusTip("Save page for offline reading")
+        snapshot_btn.triggered.connect(lambda: self.save_offline(self.tabs.currentWidget().url().toString()))
+        self.toolbar.addAction(snapshot_btn)
         self.youtube_id_bar = QLineEdit()
         self.youtube_id_bar.setPlaceholderText("YouTube Video ID")
         navtb.addWidget(self.youtube_id_bar)
@@ -122,20 +1373,25 @@ class MainWindow(QMainWindow):
         navtb.addAction(home_btn)
         navtb.addSeparator()
         self.urlbar = QLineEdit()
+        self.urlbar_url = QUrl()
         self.urlbar.returnPressed.connect(self.navigate_to_url)
+        self.suggestion_model = QStandardItemModel(self)
+        self.completer = QCompleter(self.suggestion_model, self)
+        self.completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        self.completer.setCompletionRole(Qt.ItemDataRole.UserRole)
+        self.completer.activated.connect(self.navigate_to_url)
+        self.completer.highlighted[str].connect(self.preconnector.hint)
+        self.urlbar.setCompleter(self.completer)
+        self.urlbar.textEdited.connect(self.update_suggestions)
         navtb.addWidget(self.urlbar)
-        QWebEngineProfile.defaultProfile().downloadRequested.connect(self.on_downloadRequested)
         stop_btn = QAction("❌", self)
         stop_btn.setStatusTip("Stop loading current page")
         stop_btn.triggered.connect(lambda: self.tabs.currentWidget().stop())
         navtb.addAction(stop_btn)
-        self.add_new_tab(QUrl('https://takerin-123.github.io/qqqqq.github.io/'), 'Homepage')
-        self.vertical_bar = QToolBar("Vertical Bar")
-        self.vertical_bar.setOrientation(Qt.Orientation.Vertical)
-        self.addToolBar(Qt.ToolBarArea.LeftToolBarArea, self.vertical_bar)
-        self.status = QStatusBar()
-        self.setStatusBar(self.status)
-        self.show()
+        if not self.restore_session():
+            self.add_new_tab(QUrl(self.home_url), 'Homepage')
+        startup_trace.mark("session restore")
+        self.downloads = DownloadManager(self.profile, self.status)
         self.setWindowTitle("")
         self.setStyleSheet("background-color: black; color: white;")  # 背景色を黒に変更
         self.tabs.setStyleSheet("QTabBar::tab { background-color: white; color: black; }")
@@ -143,36 +1399,121 @@ class MainWindow(QMainWindow):
         settings_btn.setStatusTip("設定")
         settings_btn.triggered.connect(self.show_settings)
         self.toolbar.addAction(settings_btn)
+        task_manager_btn = QAction("📊", self)
+        task_manager_btn.setStatusTip("Task manager")
+        task_manager_btn.triggered.connect(self.show_task_manager)
+        self.toolbar.addAction(task_manager_btn)
+        downloads_btn = QAction("⬇️", self)
+        downloads_btn.setStatusTip("Downloads")
+        downloads_btn.triggered.connect(self.toggle_download_panel)
+        self.toolbar.addAction(downloads_btn)
+        tab_switcher_btn = QAction("🗂", self)
+        tab_switcher_btn.setStatusTip("Search tabs")
+        tab_switcher_btn.triggered.connect(self.show_tab_switcher)
+        self.toolbar.addAction(tab_switcher_btn)
+        tab_switcher_shortcut = QShortcut(QKeySequence("Ctrl+Shift+A"), self)
+        tab_switcher_shortcut.activated.connect(self.show_tab_switcher)
+
+        fulltext_btn = QAction("🔎", self)
+        fulltext_btn.setStatusTip("Search visited pages")
+        fulltext_btn.triggered.connect(self.show_fulltext_search)
+        self.toolbar.addAction(fulltext_btn)
+        fulltext_shortcut = QShortcut(QKeySequence("Ctrl+Shift+F"), self)
+        fulltext_shortcut.activated.connect(self.show_fulltext_search)
         self.update_language()
         ai_btn = QAction("AI", self)
         ai_btn.setStatusTip("Use Orb AI")
         ai_btn.triggered.connect(self.open_ai_tool)
         navtb.addAction(ai_btn)
+        startup_trace.mark("toolbars")
+
     def open_ai_tool(self):
         ai_url = QUrl("https://supertakerin2-comcomgptfree.hf.space/")
         self.add_new_tab(ai_url, "AI Tool")
 
+    @perf_trace.traced("tab create", "tabs")
     def add_new_tab(self, qurl=None, label="ブランク"):
         if qurl is None:
-            qurl = QUrl('https://takerin-123.github.io/qqqqq.github.io/')
+            qurl = QUrl(self.home_url)
         elif isinstance(qurl, str):
             qurl = QUrl(qurl)
         elif not isinstance(qurl, QUrl):
             raise TypeError("qurl must be a QUrl or a string")
         
-        browser = QWebEngineView()
+        browser = self.create_browser()
         browser.setUrl(qurl)
+        self.tab_registry.register(browser)
         i = self.tabs.addTab(browser, label)
         self.tabs.setCurrentIndex(i)
-        browser.urlChanged.connect(lambda qurl, browser=browser: self.update_urlbar(qurl, browser))
-        browser.loadFinished.connect(lambda _, i=i, browser=browser: self.tabs.setTabText(i, browser.page().title()))
-        browser.iconChanged.connect(lambda _, i=i, browser=browser: self.tabs.setTabIcon(i, browser.icon()))
+        return browser
+
+    def create_browser(self):
+        browser = QWebEngineView()
+        browser.setPage(OrbPage(self.profile, self.adblock.cosmetics, browser))
+        self.dark_mode.prepare(browser)
+        # タブの表示は TabRegistry がまとめて更新するので、ここでは変化を知らせるだけにする
+        browser.urlChanged.connect(lambda _, browser=browser: self.tab_registry.touch(browser))
+        browser.titleChanged.connect(lambda _, browser=browser: self.tab_registry.touch(browser))
+        browser.iconChanged.connect(lambda _, browser=browser: self.tab_registry.touch(browser))
+        browser.urlChanged.connect(lambda _, browser=browser: self.session.mark_dirty(browser))
+        browser.urlChanged.connect(lambda qurl: self.history.record_visit(qurl.toString()))
+        browser.urlChanged.connect(lambda qurl, browser=browser: self.preconnector.navigated(browser, qurl))
+        browser.loadFinished.connect(lambda ok, browser=browser: ok and self.preconnector.page_loaded(browser))
+        browser.loadFinished.connect(lambda _, browser=browser: self.session.mark_dirty(browser))
+        browser.loadFinished.connect(lambda ok, browser=browser: ok and self.record_visit(browser))
+        browser.loadFinished.connect(lambda ok, browser=browser: ok and self.text_extractor.page_loaded(browser))
+        browser.loadFinished.connect(lambda ok, browser=browser: ok and self.history.set_title(browser.url().toString(), browser.page().title()))
+        browser.iconChanged.connect(lambda icon, browser=browser: self.favicons.store_icon(browser.url().toString(), icon))
+        return browser
+
+    def restore_session(self):
+        data = self.session.load()
+        if not data or not data.get("tabs"):
+            return False
+        # 前回のタブは軽い仮のウィジェットとして並べ、選択されたときに初めて読み込む
+        self.tabs.blockSignals(True)
+        for entry in data["tabs"]:
+            placeholder = LazyTab(entry.get("url", ""), entry.get("title", ""), entry.get("history", ""))
+            i = self.tabs.addTab(placeholder, placeholder.title[:7] or "ブランク")
+            icon = self.favicons.icon(placeholder.url)
+            if icon is not None:
+                self.tabs.setTabIcon(i, icon)
+            self.tab_registry.register(placeholder)
+        self.tabs.blockSignals(False)
+        active = data.get("active", 0)
+        self.tabs.setCurrentIndex(active if 0 <= active < self.tabs.count() else 0)
+        self.current_tab_changed(self.tabs.currentIndex())
+        return True
+
+    @perf_trace.traced("tab restore", "tabs")
+    def activate_lazy_tab(self, i, placeholder):
+        browser = self.create_browser()
+        if not (placeholder.history and self.session.restore_history(browser, placeholder.history)):
+            browser.setUrl(QUrl(placeholder.url))
+        self.tabs.blockSignals(True)
+        icon = self.tabs.tabIcon(i)
+        label = self.tabs.tabText(i)
+        self.tabs.removeTab(i)
+        self.tabs.insertTab(i, browser, icon, label)
+        self.tabs.setCurrentIndex(i)
+        self.tabs.blockSignals(False)
+        placeholder.deleteLater()
+        self.session.replace(placeholder, browser)
+        self.tab_registry.replace(placeholder, browser)
+        self.tabs.currentChanged.emit(i)
 
     def tab_open_doubleclick(self, i):
         if i == -1:
             self.add_new_tab()
 
     def current_tab_changed(self, i):
+        widget = self.tabs.widget(i)
+        if isinstance(widget, LazyTab):
+            self.activate_lazy_tab(i, widget)
+            return
+        if widget is None:
+            return
+        self.dark_mode.sync(widget)
         qurl = self.tabs.currentWidget().url()
         self.update_urlbar(qurl, self.tabs.currentWidget())
         self.update_title(self.tabs.currentWidget())
@@ -180,32 +1521,79 @@ class MainWindow(QMainWindow):
     def close_current_tab(self, i):
         if self.tabs.count() < 2:
             return
-        self.tabs.removeTab(i)
-        QWidget.deleteLater()
+        self.tab_registry.close(self.tabs.widget(i))
+
+    def tabs_updated(self, tab_ids):
+        current = self.tabs.currentWidget()
+        if self.tab_registry.id_of(current) in tab_ids and isinstance(current, QWebEngineView):
+            # タイトルやアイコンだけの変化ではアドレスバーに触らない。入力中も書き換えない
+            if (current.url() != self.urlbar_url and not self.urlbar.hasFocus()
+                    and not self.urlbar.isModified()):
+                self.update_urlbar(current.url(), current)
+            self.update_title(current)
+
+    def show_tab_switcher(self):
+        switcher = TabSwitcher(self, self.tab_registry)
+        if switcher.exec() and switcher.selected_id is not None:
+            widget = self.tab_registry.widget(switcher.selected_id)
+            if widget is not None:
+                self.tabs.setCurrentWidget(widget)
+
+    def show_fulltext_search(self):
+        dialog = FullTextSearchDialog(self, self.fulltext)
+        if dialog.exec() and dialog.selected_url:
+            self.add_new_tab(QUrl(dialog.selected_url))
+
     def update_title(self, browser):
         if browser != self.tabs.currentWidget():
             return
-        title = self.tabs.currentWidget().page().title()
-        formatted_title = title[:7] if len(title) > 7 else title.ljust(7)
-        self.setWindowTitle("%s OrbBrowser" % formatted_title)
-        self.tabs.setTabText(self.tabs.currentIndex(), formatted_title)
+        self.setWindowTitle("%s OrbBrowser" % format_tab_title(browser.page().title()))
 
     def navigate_home(self):
-        self.tabs.currentWidget().setUrl(QUrl("https://takerin-123.github.io/qqqqq.github.io/"))
+        self.tabs.currentWidget().setUrl(QUrl(self.home_url))
 
-    def navigate_to_url(self):
-        url = self.urlbar.text()
-        if "google.com/search?q=" in url:
-            self.tabs.currentWidget().setUrl(QUrl(url))
+    def navigate_to_url(self, text=None):
+        text = self.urlbar.text() if text is None else text
+        url = looks_like_url(text)
+        if url is None:
+            url = "https://www.google.com/search?q=" + urllib.parse.quote_plus(text)
+        self.tabs.currentWidget().setUrl(QUrl(url))
+        self.urlbar.setModified(False)
+        self.tabs.currentWidget().setFocus()
+
+    def update_suggestions(self, text):
+        self.suggestion_model.clear()
+        for url, title in self.omnibox.query(text):
+            item = QStandardItem(f"{title}  —  {url}" if title else url)
+            item.setData(url, Qt.ItemDataRole.UserRole)
+            self.suggestion_model.appendRow(item)
+        if self.suggestion_model.rowCount():
+            self.completer.complete()
         else:
-            google_search_url = "https://www.google.com/search?q=" + url
-            self.tabs.currentWidget().setUrl(QUrl(google_search_url))
+            self.completer.popup().hide()
+
+    def history_loaded(self, index):
+        # 起動後に記録した訪問やブックマークを、バックグラウンドで組み立てた索引に移す
+        for url, title, score, _ in list(self.omnibox.entries.values()):
+            entry = index.entries.get(url)
+            index.add(url, title, score if entry is None else max(score, entry[2]))
+        self.omnibox = index
+        # よく訪れるオリジンへの接続を先に温めておく
+        origins = dict.fromkeys(FaviconCache.origin(url) for url, _, _, _ in self.history.top("frecency", 50))
+        origins.pop(None, None)
+        self.preconnector.warm(list(origins)[:PRECONNECT_TOP_ORIGINS])
+
+    def record_visit(self, browser):
+        url = browser.url().toString()
+        if url.startswith(("http://", "https://")):
+            self.omnibox.visit(url, browser.page().title())
 
     def update_urlbar(self, q, browser=None):
         if browser != self.tabs.currentWidget():
             return
         self.urlbar.setText(q.toString())
         self.urlbar.setCursorPosition(0)
+        self.urlbar_url = q
 
     def extract_video_id(self, youtube_url):
         video_id_pattern = re.compile(r'(?:youtube\.com/watch\?v=|youtu\.be/)([^&?/\s]+)')
@@ -223,109 +1611,121 @@ class MainWindow(QMainWindow):
         else:
             pass
 
-    def on_downloadRequested(self, download):
-        home_dir = os.path.expanduser("~")
-        download_dir = os.path.join(home_dir, "Downloads")
-        download_filename = download.suggestedFileName()
-        QWebEngineProfile.defaultProfile().setDownloadDirectory(download_dir)
-        download.setDownloadFileName(download_filename)
-        download.accept()
-        self.show_download_progress(download)
-
-    def show_download_progress(self, download):
-        progress_bar = QProgressBar(self.status)
-        self.status.addPermanentWidget(progress_bar)
-        download.downloadProgress.connect(lambda bytesReceived, bytesTotal, progress_bar=progress_bar: progress_bar.setValue(int((bytesReceived / bytesTotal) * 100) if bytesTotal > 0 else 0))
-        download.finished.connect(lambda progress_bar=progress_bar: progress_bar.deleteLater())
-
-    def update_progress_bar(self, progress_bar, bytesReceived, bytesTotal):
-        if bytesTotal > 0:
-            progress = (bytesReceived / bytesTotal) * 100
-            progress_bar.setValue(int(progress))
-
-    def remove_progress_bar(self, progress_bar):
-        self.status.removeWidget(progress_bar)
-        progress_bar.deleteLater()
+    def toggle_download_panel(self):
+        self.start_background_services()
+        self.download_panel.setVisible(not self.download_panel.isVisible())
 
     def download_youtube_video(self):
-        youtube_url = self.youtube_download_bar.text()
-        video_id = self.extract_video_id(youtube_url)
-        if video_id:
-            threading.Thread(target=self.download_video, args=(video_id,)).start()
-        else:
-            pass
-
-    def download_video(self, video_id):
-        ydl_opts = {'format': 'mp4'}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([f'http://www.youtube.com/watch?v={video_id}'])
+        urls = []
+        for text in self.youtube_download_bar.text().split():
+            video_id = self.extract_video_id(text)
+            if video_id and "list=" not in text:
+                urls.append(f'https://www.youtube.com/watch?v={video_id}')
+            elif text.startswith(("http://", "https://")):
+                # 再生リストやその他の URL は yt-dlp にそのまま渡す
+                urls.append(text)
+        if urls:
+            self.start_background_services()
+            self.video_downloads.add(urls)
+            self.youtube_download_bar.clear()
+            self.download_panel.show()
+            self.download_panel.pages.setCurrentIndex(1)
 
+    @perf_trace.traced("bookmark save", "bookmarks")
     def add_shortcut(self):
         current_tab = self.tabs.currentWidget()
         if isinstance(current_tab, QWebEngineView):
             url = current_tab.page().url().toString()
             title = current_tab.page().title()
-            shortcut_button = QAction("", self)
-            shortcut_button.setText(current_tab.page().title())
-            shortcut_button.setToolTip(url)
-            shortcut_button.triggered.connect(lambda: self.tabs.currentWidget().setUrl(QUrl(url)))
-            self.vertical_bar.addAction(shortcut_button)
-            self.tabs.currentWidget().setUrl(QUrl(url))
-            self.save_shortcut_to_xml(title, url)
-
-    def save_shortcut_to_xml(self, title, url):
-        if not os.path.exists('shortcuts.xml'):
-            root = ET.Element("shortcuts")
-            tree = ET.ElementTree(root)
-            tree.write('shortcuts.xml')
-        tree = ET.parse('shortcuts.xml')
-        root = tree.getroot()
-        for shortcut in root.findall('shortcut'):
-            if shortcut.find('url').text == url:
+            if not self.bookmarks.add(url, title):
                 print("Bookmark already exists.")
                 return
-        shortcut = ET.SubElement(root, 'shortcut')
-        ET.SubElement(shortcut, 'title').text = title
-        ET.SubElement(shortcut, 'url').text = url
-        tree.write('shortcuts.xml')
+            self.omnibox.visit(url, title, OMNIBOX_BOOKMARK_WEIGHT)
+            self.add_website_shortcut(url, title)
+            self.tabs.currentWidget().setUrl(QUrl(url))
 
+    @perf_trace.traced("bookmarks load", "bookmarks")
     def load_shortcuts(self):
-        if not os.path.exists('shortcuts.xml'):
-            return
-        tree = ET.parse('shortcuts.xml')
-        root = tree.getroot()
-        added_urls = set()
-        for shortcut in root.findall('shortcut'):
-            title = shortcut.find('title').text
-            url = shortcut.find('url').text
-            if url not in added_urls:
-                self.add_website_shortcut(url, title)
-                added_urls.add(url)
-
-    def add_website_shortcut(self, url, name):
+        folder_menus = {}
+        for folder_id, parent_id, name in self.bookmarks.folders():
+            menu = QMenu(name, self)
+            folder_menus[folder_id] = menu
+            parent_menu = folder_menus.get(parent_id)
+            if parent_menu is not None:
+                parent_menu.addMenu(menu)
+            else:
+                self.vertical_bar.addAction(menu.menuAction())
+        for url, title, folder_id in self.bookmarks.all():
+            self.add_website_shortcut(url, title, folder_menus.get(folder_id))
+            self.omnibox.visit(url, title, OMNIBOX_BOOKMARK_WEIGHT)
+
+    def add_website_shortcut(self, url, name, folder_menu=None):
         name = name[:23] + '...' if len(name) > 23 else name
-        shortcut_button = QAction(name, self)
-        shortcut_button.url = url
-        view = QWebEngineView()
-        view.load(QUrl(url))
-        view.iconChanged.connect(lambda icon, button=shortcut_button: button.setIcon(icon))
-        shortcut_button.triggered.connect(lambda: self.tabs.currentWidget().setUrl(QUrl(url)))
-        self.vertical_bar.addAction(shortcut_button)
-        self.save_shortcut_to_xml(name, url)
-
-    def create_database(self):
-        if not os.path.exists('shortcuts.xml'):
-            root = ET.Element("shortcuts")
-            tree = ET.ElementTree(root)
-            tree.write('shortcuts.xml')
+        shortcut_button = BookmarkAction(name, url, self.bookmarks, self, self.snapshots)
+        shortcut_button.saveOfflineRequested.connect(self.save_offline)
+        shortcut_button.setToolTip(url)
+        shortcut_button.hovered.connect(lambda: self.preconnector.hint(url))
+        icon = self.favicons.icon(url)
+        if icon is not None:
+            shortcut_button.setIcon(icon)
+        else:
+            self.favicons.request(url)
+        shortcut_button.triggered.connect(lambda: self.open_bookmark(url))
+        if folder_menu is not None:
+            folder_menu.addAction(shortcut_button)
+        else:
+            self.vertical_bar.addAction(shortcut_button)
+
+    def open_bookmark(self, url):
+        browser = self.tabs.currentWidget()
+        if not self.snapshots.has(url):
+            browser.setUrl(QUrl(url))
+            return
+        self.snapshots.open(url, lambda path, browser=browser: browser.setUrl(QUrl.fromLocalFile(path)))
+
+    def save_offline(self, url):
+        # 開いているタブがあればそれを、無ければ新しいタブで読み込んでから保存する
+        for i in range(self.tabs.count()):
+            view = self.tabs.widget(i)
+            if isinstance(view, QWebEngineView) and view.url().toString() == url and not view.page().isLoading():
+                self.snapshots.capture(view)
+                return
+        browser = self.add_new_tab(QUrl(url))
+
+        def loaded(ok):
+            browser.loadFinished.disconnect(loaded)
+            if ok:
+                self.snapshots.capture(browser)
+        browser.loadFinished.connect(loaded)
+
+    def snapshot_saved(self, url):
+        self.status.showMessage(f"オフライン用に保存しました: {url}", 5000)
+
+    def snapshot_stale(self, url):
+        self.status.showMessage(f"保存後にページが更新されています: {url}", 10000)
+
+    def update_bookmark_icons(self, origin, icon):
+        for action in self.findChildren(BookmarkAction):
+            if FaviconCache.origin(action.url) == origin:
+                action.setIcon(icon)
+
+    def show_bookmark_menu(self, point):
+        action = self.vertical_bar.actionAt(point)
+        if isinstance(action, BookmarkAction):
+            action.showContextMenu(self.vertical_bar.mapToGlobal(point))
 
     def show_settings(self):
-        settings_dialog = SettingsDialog(self, self.memory_saver, self.dark_mode, self.language)
+        settings_dialog = SettingsDialog(self, self.memory_saver, self.dark_mode, self.language, self.profile)
         settings_dialog.exec()
         self.language = settings_dialog.language
         self.save_settings()
         self.update_language()
 
+    def show_task_manager(self):
+        self.telemetry.sample()
+        TaskManagerDialog(self, self.tabs, self.telemetry, self.memory_saver, self.preconnector, self.snapshots).exec()
+
+    @perf_trace.traced("settings save", "settings")
     def save_settings(self):
         root = ET.Element("settings")
         tree = ET.ElementTree(root)
@@ -333,10 +1733,17 @@ class MainWindow(QMainWindow):
         language_element.text = self.language
         memory_saver_element = ET.SubElement(root, "memory_saver")
         memory_saver_element.text = str(self.memory_saver.memory_saver_enabled)
+        memory_budget_element = ET.SubElement(root, "memory_budget_mb")
+        memory_budget_element.text = str(self.memory_saver.memory_budget_mb)
+        http_cache_element = ET.SubElement(root, "http_cache_mb")
+        http_cache_element.text = str(self.profile.httpCacheMaximumSize() // (1024 * 1024))
         dark_mode_element = ET.SubElement(root, "dark_mode")
         dark_mode_element.text = str(self.dark_mode.dark_mode_enabled)
+        dark_mode_exclusions_element = ET.SubElement(root, "dark_mode_exclusions")
+        dark_mode_exclusions_element.text = ",".join(sorted(self.dark_mode.excluded_sites))
         tree.write("settings.xml")
 
+    @perf_trace.traced("settings load", "settings")
     def load_settings(self):
         if not os.path.exists("settings.xml"):
             return
@@ -347,10 +1754,19 @@ class MainWindow(QMainWindow):
             self.language = language_element.text
         memory_saver_element = root.find("memory_saver")
         if memory_saver_element is not None:
-            self.memory_saver.memory_saver_enabled = bool(memory_saver_element.text)
+            self.memory_saver.memory_saver_enabled = memory_saver_element.text == "True"
+        memory_budget_element = root.find("memory_budget_mb")
+        if memory_budget_element is not None and (memory_budget_element.text or "").isdigit():
+            self.memory_saver.memory_budget_mb = int(memory_budget_element.text)
+        http_cache_element = root.find("http_cache_mb")
+        if http_cache_element is not None and (http_cache_element.text or "").isdigit():
+            self.profile.setHttpCacheMaximumSize(int(http_cache_element.text) * 1024 * 1024)
         dark_mode_element = root.find("dark_mode")
+        dark_mode_exclusions_element = root.find("dark_mode_exclusions")
+        if dark_mode_exclusions_element is not None:
+            self.dark_mode.set_excluded_sites(dark_mode_exclusions_element.text or "")
         if dark_mode_element is not None:
-            self.dark_mode.dark_mode_enabled = bool(dark_mode_element.text)
+            self.dark_mode.toggle_dark_mode(dark_mode_element.text == "True")
         self.update_language()
 
     def update_language(self):
@@ -361,117 +1777,2516 @@ class MainWindow(QMainWindow):
         elif self.language == "中文":
             self.setWindowTitle("关于 Orb Browser")
 
-class BookmarkAction(QAction):
-    def __init__(self, title, parent):
-        super().__init__(title, parent)
-        self.setContextMenuPolicy(Qt.ActionsContextMenu)
-        self.customContextMenuRequested.connect(self.showContextMenu)
-        self.url = ""
+def frecency_add(score, weight=1.0, when=None):
+    # 訪問ごとの重みを時間で指数的に減衰させた合計を対数で持つ。基準時刻からの経過で
+    # 新しい訪問ほど大きくなるので、保存済みの値を後から減衰させ直す必要がない
+    when = time.time() if when is None else when
+    value = math.log(weight) + (when - FRECENCY_EPOCH) * math.log(2) / FRECENCY_HALF_LIFE
+    if score is None:
+        return value
+    return max(score, value) + math.log1p(math.exp(-abs(score - value)))
 
-    def showContextMenu(self, point):
-        contextMenu = QMenu(self.parent())
-        deleteAction = QAction("削除", self)
-        deleteAction.triggered.connect(self.deleteBookmark)
-        contextMenu.addAction(deleteAction)
-        contextMenu.exec_(self.mapToGlobal(point))
 
-    def deleteBookmark(self):
-        tree = ET.parse('shortcuts.xml')
-        root = tree.getroot()
-        for shortcut in root.findall('shortcut'):
-            if shortcut.find('url').text == self.url:
-                root.remove(shortcut)
-                tree.write('shortcuts.xml')
+def looks_like_url(text):
+    text = text.strip()
+    if not text or " " in text:
+        return None
+    scheme = re.match(r"([a-zA-Z][a-zA-Z0-9+.\-]*):", text)
+    if scheme and scheme.group(1).lower() in URL_SCHEMES:
+        return text
+    match = re.match(r"([^/?#:]+)(:\d+)?([/?#].*)?$", text)
+    if not match:
+        return None
+    host = match.group(1).lower()
+    if host == "localhost" or re.fullmatch(r"\d{1,3}(\.\d{1,3}){3}", host):
+        return "http://" + text
+    labels = host.split(".")
+    tld = labels[-1]
+    if tld in AMBIGUOUS_TLDS and len(labels) == 2 and not (match.group(2) or match.group(3)):
+        return None
+    if len(labels) >= 2 and (tld in COUNTRY_TLDS or tld in GENERIC_TLDS or re.fullmatch(r"xn--[a-z0-9\-]+", tld)) \
+            and all(re.fullmatch(r"[a-z0-9\-_]{1,63}|xn--[a-z0-9\-]+", label) for label in labels[:-1]):
+        return "https://" + text
+    return None
+
+
+class OmniboxIndex:
+    def __init__(self, limit=OMNIBOX_SUGGESTIONS):
+        self.limit = limit
+        self.entries = {}
+        # (キー, URL) を整列したままブロックに分けて持ち、前方一致の範囲を二分探索で引く。
+        # 各ブロックにはスコアの上限を持たせ、上位 k 件に届かないブロックは読まずに済ませる
+        self.blocks = []
+        self.firsts = []
+        self.bounds = []
+        # 短い前方一致は候補が多すぎるので、上位の URL だけを前もって保持して差分で更新する
+        self.top = {}
+
+    @staticmethod
+    def normalize(text):
+        text = text.strip().lower()
+        for prefix in ("https://", "http://"):
+            if text.startswith(prefix):
+                text = text[len(prefix):]
                 break
-        self.parent().removeAction(self)
+        if text.startswith("www."):
+            text = text[4:]
+        return text
 
-class MemorySaver(QObject):
-    def __init__(self, tabs):
-        super().__init__()
-        self.tabs = tabs
-        self.tabs.currentChanged.connect(self.save_memory)
-        self.memory_saver_enabled = False
-        self.last_access_times = {}
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.check_inactive_tabs)
-        self.timer.start(60000)  # 1分ごとにチェック
+    def entry_keys(self, url, title):
+        keys = {self.normalize(url)}
+        for word in title.lower().split()[:OMNIBOX_TITLE_WORDS]:
+            if len(word) >= 2:
+                keys.add(word)
+        return keys
 
+    def __len__(self):
+        return len(self.entries)
 
-    def save_memory(self, index):
-        if self.memory_saver_enabled:
-            current_time = QDateTime.currentDateTime()
-            for i in range(self.tabs.count()):
-                if i != index:
-                    if i not in self.last_access_times:
-                        self.last_access_times[i] = current_time
-                    self.tabs.widget(i).setVisible(False)
-                else:
-                    self.last_access_times[i] = current_time
-                    self.tabs.widget(i).setVisible(True)
-        else:
-            for i in range(self.tabs.count()):
-                self.tabs.widget(i).setVisible(True)
+    def add(self, url, title="", score=None):
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = [url, title or "", frecency_add(None) if score is None else score, set()]
+            self.set_keys(entry, self.entry_keys(url, entry[1]))
+            self.promote(entry)
+            return entry
+        if title and title != entry[1]:
+            self.set_title(url, title)
+        if score is not None and score != entry[2]:
+            lowered = score < entry[2]
+            entry[2] = score
+            if lowered:
+                self.invalidate(entry)
+            else:
+                self.raise_bounds(entry)
+                self.promote(entry)
+        return entry
 
-    def toggle_memory_saver(self, enabled):
-        self.memory_saver_enabled = enabled
-        self.save_memory(self.tabs.currentIndex())
+    def add_many(self, items):
+        # 大量の履歴は一つずつ挿入せず、まとめて並べ替える
+        for url, title, score in items:
+            entry = self.entries.get(url)
+            if entry is not None:
+                entry[1] = title or entry[1]
+                entry[2] = max(entry[2], score)
+                entry[3] |= self.entry_keys(url, entry[1])
+            else:
+                self.entries[url] = [url, title or "", score, self.entry_keys(url, title or "")]
+        keys = sorted((key, url) for url, entry in self.entries.items() for key in entry[3])
+        self.blocks = [keys[i:i + OMNIBOX_BLOCK] for i in range(0, len(keys), OMNIBOX_BLOCK)]
+        self.firsts = [block[0] for block in self.blocks]
+        self.bounds = [max(self.entries[url][2] for _, url in block) for block in self.blocks]
+        self.top.clear()
 
-    def check_inactive_tabs(self):
-        if not self.memory_saver_enabled:
+    def visit(self, url, title="", weight=1.0, when=None):
+        entry = self.entries.get(url)
+        if entry is None:
+            return self.add(url, title, frecency_add(None, weight, when))
+        return self.add(url, title, frecency_add(entry[2], weight, when))
+
+    def set_title(self, url, title):
+        entry = self.entries.get(url)
+        if entry is None or title == entry[1]:
             return
+        entry[1] = title
+        self.invalidate(entry)
+        self.set_keys(entry, self.entry_keys(url, title))
+        self.promote(entry)
 
-        current_time = QDateTime.currentDateTime()
+    def remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.invalidate(entry)
+            self.set_keys(entry, set())
+
+    def block_of(self, item):
+        return max(0, bisect.bisect_right(self.firsts, item) - 1)
+
+    def set_keys(self, entry, keys):
+        url, score = entry[0], entry[2]
+        for key in entry[3] - keys:
+            b = self.block_of((key, url))
+            block = self.blocks[b] if self.blocks else []
+            i = bisect.bisect_left(block, (key, url))
+            if i < len(block) and block[i] == (key, url):
+                del block[i]
+                if not block:
+                    del self.blocks[b], self.firsts[b], self.bounds[b]
+                else:
+                    self.firsts[b] = block[0]
+        for key in keys - entry[3]:
+            if not self.blocks:
+                self.blocks, self.firsts, self.bounds = [[]], [(key, url)], [score]
+            b = self.block_of((key, url))
+            block = self.blocks[b]
+            bisect.insort(block, (key, url))
+            self.firsts[b] = block[0]
+            self.bounds[b] = max(self.bounds[b], score)
+            if len(block) >= OMNIBOX_BLOCK * 2:
+                half = block[OMNIBOX_BLOCK:]
+                del block[OMNIBOX_BLOCK:]
+                self.blocks.insert(b + 1, half)
+                self.firsts.insert(b + 1, half[0])
+                self.bounds.insert(b + 1, self.bounds[b])
+        entry[3] = keys
+
+    def raise_bounds(self, entry):
+        # 上限は大きめでも結果は変わらないので、削除やスコアの低下では下げない
+        url, score = entry[0], entry[2]
+        for key in entry[3]:
+            b = self.block_of((key, url))
+            if score > self.bounds[b]:
+                self.bounds[b] = score
+
+    def short_prefixes(self, entry):
+        prefixes = set()
+        for key in entry[3]:
+            for n in range(1, OMNIBOX_CACHED_PREFIX + 1):
+                prefixes.add(key[:n])
+        return prefixes
+
+    def promote(self, entry):
+        url, score = entry[0], entry[2]
+        for prefix in self.short_prefixes(entry):
+            top = self.top.get(prefix)
+            if top is None:
+                continue
+            if url in top:
+                top.sort(key=lambda u: self.entries[u][2], reverse=True)
+            elif len(top) < self.limit or score > self.entries[top[-1]][2]:
+                top.append(url)
+                top.sort(key=lambda u: self.entries[u][2], reverse=True)
+                del top[self.limit:]
+
+    def invalidate(self, entry):
+        # 順位が下がった場合は次の問い合わせで作り直す
+        for prefix in self.short_prefixes(entry):
+            self.top.pop(prefix, None)
+
+    def scan(self, prefix, limit):
+        if not self.blocks:
+            return []
+        lo, hi = (prefix,), (prefix + "\uffff",)
+        entries = self.entries
+        found = {}
+        threshold = None
+        # 上限の大きいブロックから読み、残りの上限が k 位のスコアを下回ったら打ち切る
+        candidates = range(self.block_of(lo), self.block_of(hi) + 1)
+        for b in sorted(candidates, key=self.bounds.__getitem__, reverse=True):
+            if threshold is not None and self.bounds[b] <= threshold:
+                break
+            block = self.blocks[b]
+            start = bisect.bisect_left(block, lo)
+            end = bisect.bisect_left(block, hi, start)
+            if start == end:
+                continue
+            for _, url in block[start:end]:
+                found[url] = entries[url][2]
+            if start == 0 and end == len(block):
+                # ブロックを全部読んだときは上限を実際の最大値まで締め直す
+                self.bounds[b] = max(entries[url][2] for _, url in block)
+            if len(found) >= limit:
+                threshold = heapq.nlargest(limit, found.values())[-1]
+        return heapq.nlargest(limit, found, key=found.get)
+
+    def query(self, text, limit=None):
+        limit = limit or self.limit
+        prefix = self.normalize(text)
+        if not prefix:
+            return []
+        if len(prefix) <= OMNIBOX_CACHED_PREFIX and limit <= self.limit:
+            top = self.top.get(prefix)
+            if top is None:
+                top = self.top[prefix] = self.scan(prefix, self.limit)
+            urls = top[:limit]
+        else:
+            urls = self.scan(prefix, limit)
+        return [(url, self.entries[url][1]) for url in urls]
+
+
+class HistoryStore(QObject):
+    loaded = Signal(object)
+
+    def __init__(self, path=HISTORY_DB):
+        super().__init__()
+        self.path = path
+        self.queue = queue.Queue()
+        self.reader = None
+        self.full_text = False
+        self.thread = threading.Thread(target=self.run, name="orb-history", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def create_schema(self, db):
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS places (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                title TEXT NOT NULL DEFAULT '',
+                visit_count INTEGER NOT NULL DEFAULT 0,
+                last_visit REAL NOT NULL,
+                frecency REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS visits (
+                id INTEGER PRIMARY KEY,
+                place_id INTEGER NOT NULL REFERENCES places(id),
+                visited_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS places_by_frecency ON places(frecency);
+            CREATE INDEX IF NOT EXISTS places_by_last_visit ON places(last_visit);
+            CREATE INDEX IF NOT EXISTS visits_by_time ON visits(visited_at);
+            CREATE INDEX IF NOT EXISTS visits_by_place ON visits(place_id);
+        """)
+        # 部分一致検索は trigram の FTS5 索引で引く (使えない SQLite では LIKE に戻る)
+        existed = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'places_text'").fetchone() is not None
+        try:
+            db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS places_text USING fts5(
+                    url, title, content='places', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS places_text_insert AFTER INSERT ON places BEGIN
+                    INSERT INTO places_text(rowid, url, title) VALUES (new.id, new.url, new.title);
+                END;
+                CREATE TRIGGER IF NOT EXISTS places_text_delete AFTER DELETE ON places BEGIN
+                    INSERT INTO places_text(places_text, rowid, url, title) VALUES ('delete', old.id, old.url, old.title);
+                END;
+                CREATE TRIGGER IF NOT EXISTS places_text_update AFTER UPDATE OF url, title ON places BEGIN
+                    INSERT INTO places_text(places_text, rowid, url, title) VALUES ('delete', old.id, old.url, old.title);
+                    INSERT INTO places_text(rowid, url, title) VALUES (new.id, new.url, new.title);
+                END;
+            """)
+            if not existed:
+                with db:
+                    db.execute("INSERT INTO places_text(places_text) VALUES ('rebuild')")
+            self.full_text = True
+        except sqlite3.OperationalError as e:
+            print(f"History full-text index unavailable: {e}")
+
+    def record_visit(self, url, title=""):
+        if url.startswith(("http://", "https://")):
+            self.queue.put(("visit", url, title, time.time()))
+
+    def set_title(self, url, title):
+        if url.startswith(("http://", "https://")) and title:
+            self.queue.put(("title", url, title, None))
+
+    def close(self, timeout=5):
+        # 最初の描画より前に終了した場合はスレッドがまだ起動していない
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self):
+        # 書き込みはすべてこのスレッドで行い、一定時間か一定件数ごとにまとめてコミットする
+        db = self.connect()
+        self.create_schema(db)
+        self.expire(db)
+        last_expire = time.monotonic()
+        self.loaded.emit(self.build_omnibox_index(db))
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            if pending and (not item or len(pending) >= HISTORY_FLUSH_BATCH or time.monotonic() >= deadline):
+                self.flush(db, pending)
+                pending = []
+                deadline = None
+                if time.monotonic() - last_expire > 24 * 60 * 60:
+                    self.expire(db)
+                    last_expire = time.monotonic()
+        if pending:
+            self.flush(db, pending)
+        db.close()
+
+    def flush(self, db, items):
+        try:
+            with db:
+                for kind, url, title, when in items:
+                    if kind == "visit":
+                        row = db.execute("SELECT id, frecency FROM places WHERE url = ?", (url,)).fetchone()
+                        if row is None:
+                            place_id = db.execute(
+                                "INSERT INTO places (url, title, visit_count, last_visit, frecency) VALUES (?, ?, 1, ?, ?)",
+                                (url, title, when, frecency_add(None, when=when))).lastrowid
+                        else:
+                            place_id = row[0]
+                            db.execute("UPDATE places SET visit_count = visit_count + 1, last_visit = ?, frecency = ? WHERE id = ?",
+                                       (when, frecency_add(row[1], when=when), place_id))
+                            if title:
+                                db.execute("UPDATE places SET title = ? WHERE id = ? AND title != ?", (title, place_id, title))
+                        db.execute("INSERT INTO visits (place_id, visited_at) VALUES (?, ?)", (place_id, when))
+                    elif kind == "title":
+                        db.execute("UPDATE places SET title = ? WHERE url = ? AND title != ?", (title, url, title))
+        except sqlite3.Error as e:
+            print(f"An error occurred: {e}")
+
+    def expire(self, db):
+        cutoff = time.time() - HISTORY_RETENTION_DAYS * 24 * 60 * 60
+        try:
+            with db:
+                db.execute("DELETE FROM visits WHERE visited_at < ?", (cutoff,))
+                db.execute("DELETE FROM places WHERE last_visit < ? AND NOT EXISTS "
+                           "(SELECT 1 FROM visits WHERE visits.place_id = places.id)", (cutoff,))
+            db.execute("PRAGMA incremental_vacuum")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print(f"An error occurred: {e}")
+
+    def build_omnibox_index(self, db):
+        index = OmniboxIndex()
+        index.add_many(db.execute("SELECT url, title, frecency FROM places ORDER BY frecency DESC LIMIT ?",
+                                  (HISTORY_OMNIBOX_ENTRIES,)))
+        return index
+
+    def read_connection(self):
+        if self.reader is None:
+            self.reader = sqlite3.connect(self.path)
+        return self.reader
+
+    def search(self, text, order="frecency", limit=50):
+        column = {"frecency": "frecency", "recency": "last_visit"}[order]
+        if self.full_text and len(text) >= 3:
+            return self.read_connection().execute(
+                f"SELECT places.url, places.title, places.visit_count, places.last_visit FROM places_text"
+                f" JOIN places ON places.id = places_text.rowid WHERE places_text MATCH ?"
+                f" ORDER BY places.{column} DESC LIMIT ?",
+                ('"' + text.replace('"', '""') + '"', limit)).fetchall()
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        # 索引順に走査すると一致が少ないとき遅いので、全件走査してから並べ替える
+        return self.read_connection().execute(
+            f"SELECT url, title, visit_count, last_visit FROM places"
+            f" WHERE url LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\' ORDER BY +{column} DESC LIMIT ?",
+            (pattern, pattern, limit)).fetchall()
+
+    def top(self, order="frecency", limit=50):
+        column = {"frecency": "frecency", "recency": "last_visit"}[order]
+        return self.read_connection().execute(
+            f"SELECT url, title, visit_count, last_visit FROM places ORDER BY {column} DESC LIMIT ?", (limit,)).fetchall()
+
+    def visits(self, before=None, limit=100):
+        return self.read_connection().execute(
+            "SELECT places.url, places.title, visits.visited_at FROM visits JOIN places ON places.id = visits.place_id"
+            " WHERE visits.visited_at < ? ORDER BY visits.visited_at DESC LIMIT ?",
+            (time.time() if before is None else before, limit)).fetchall()
+
+
+def create_profile(storage_dir=PROFILE_DIR, cache_mb=HTTP_CACHE_MB):
+    # 名前付きのプロファイルはディスクに保存される。defaultProfile() と違い置き場所と
+    # キャッシュの大きさをこちらで決められる
+    storage_dir = os.path.abspath(storage_dir)
+    profile = QWebEngineProfile(PROFILE_NAME, QApplication.instance())
+    profile.setPersistentStoragePath(os.path.join(storage_dir, "storage"))
+    profile.setCachePath(os.path.join(storage_dir, "cache"))
+    profile.setHttpCacheType(QWebEngineProfile.HttpCacheType.DiskHttpCache)
+    profile.setHttpCacheMaximumSize(cache_mb * 1024 * 1024)
+    profile.setPersistentCookiesPolicy(QWebEngineProfile.PersistentCookiesPolicy.ForcePersistentCookies)
+    profile.settings().setAttribute(QWebEngineSettings.WebAttribute.DnsPrefetchEnabled, True)
+    return profile
+
+
+def preconnect_html(origins):
+    links = "".join(f'<link rel="{rel}" href="{html.escape(origin)}">'
+                    for origin in origins for rel in ("dns-prefetch", "preconnect"))
+    return f"<!DOCTYPE html><html><head>{links}</head><body></body></html>"
+
+
+# 遷移したページ自身の Navigation Timing を見て、新しい接続を張らずに済んだかを返す
+# (キャッシュから出した場合は接続を使っていないので null)
+NAVIGATION_REUSE_JS = """(function() {
+    var entry = performance.getEntriesByType('navigation')[0];
+    if (!entry || !entry.transferSize) return null;
+    return entry.connectStart === entry.connectEnd;
+})();"""
+
+
+class Preconnector(QObject):
+    # 次に開かれそうなオリジンの DNS 解決と接続を先に済ませておく。QtWebEngine には直接の
+    # API がないので、同じプロファイルの表示しないページに <link rel="preconnect"> を並べて
+    # Chromium に任せる (接続はプロファイル内で共有されるので、どのタブからの遷移でも使われる)。
+    # 閲覧中のサイトから履歴やブックマークが見えないよう、タブのページには何も差し込まない
+    def __init__(self, profile, tabs, ttl=PRECONNECT_TTL, delay_ms=PRECONNECT_DELAY_MS):
+        super().__init__()
+        self.profile = profile
+        self.tabs = tabs
+        self.ttl = ttl
+        self.page = None
+        self.warmed = {}
+        self.pending = []
+        self.checking = {}
+        self.issued = 0
+        self.hits = 0
+        self.navigations = 0
+        # ホバーやハイライトが素早く移っていく間は投げず、止まったところだけを温める
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay_ms)
+        self.timer.timeout.connect(self.flush)
+
+    def hint(self, url):
+        origin = FaviconCache.origin(url)
+        if origin is not None:
+            self.pending = [origin]
+            self.timer.start()
+
+    def warm(self, urls):
+        self.preconnect([origin for origin in map(FaviconCache.origin, urls) if origin is not None])
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.preconnect(pending)
+
+    def preconnect(self, origins):
+        now = time.monotonic()
+        view = self.tabs.currentWidget()
+        current = FaviconCache.origin(view.url().toString()) if isinstance(view, QWebEngineView) else None
+        fresh = [origin for origin in dict.fromkeys(origins)
+                 if origin != current and now - self.warmed.get(origin, -self.ttl) > self.ttl]
+        if not fresh:
+            return
+        if self.page is None:
+            self.page = QWebEnginePage(self.profile, self)
+            self.page.settings().setAttribute(QWebEngineSettings.WebAttribute.JavascriptEnabled, False)
+        for origin in fresh:
+            self.warmed[origin] = now
+        self.issued += len(fresh)
+        perf_trace.instant("preconnect", "network", {"origins": fresh})
+        self.page.setHtml(preconnect_html(fresh))
+
+    def navigated(self, view, url):
+        origin = FaviconCache.origin(url.toString())
+        if origin is None:
+            return
+        self.navigations += 1
+        warmed = self.warmed.pop(origin, None)
+        if warmed is not None and time.monotonic() - warmed <= self.ttl:
+            self.checking[view] = origin
+        else:
+            self.checking.pop(view, None)
+
+    def page_loaded(self, view):
+        # 温めたオリジンへ遷移しただけでは数えず、実際に接続を使い回せたものだけを当たりにする
+        origin = self.checking.pop(view, None)
+        if origin is None or FaviconCache.origin(view.url().toString()) != origin:
+            return
+        view.page().runJavaScript(NAVIGATION_REUSE_JS, QWebEngineScript.ApplicationWorld, self.checked)
+
+    def checked(self, reused):
+        if reused is True:
+            self.hits += 1
+
+    def forget(self, view):
+        self.checking.pop(view, None)
+
+    def stats(self):
+        return {
+            "issued": self.issued,
+            "hits": self.hits,
+            "navigations": self.navigations,
+            "hit_rate": self.hits / self.issued if self.issued else 0.0,
+        }
+
+
+def page_text_js(limit=FULLTEXT_MAX_CHARS, max_elements=FULLTEXT_MAX_ELEMENTS):
+    # innerText はレイアウトを強制するので使わず、テキストノードを上限まで拾う。
+    # 要素数が多すぎる文書は丸ごと飛ばす
+    return """(function(limit, maxElements) {
+    if (!document.body || document.getElementsByTagName('*').length > maxElements) return null;
+    var skip = {SCRIPT: 1, STYLE: 1, NOSCRIPT: 1, TEMPLATE: 1};
+    var walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT, {
+        acceptNode: function(node) {
+            return node.parentNode && skip[node.parentNode.nodeName] ? NodeFilter.FILTER_REJECT : NodeFilter.FILTER_ACCEPT;
+        }
+    });
+    var parts = [], size = 0, node;
+    while (size < limit && (node = walker.nextNode())) {
+        var text = node.nodeValue.replace(/\\s+/g, ' ').trim();
+        if (text) {
+            parts.push(text);
+            size += text.length + 1;
+        }
+    }
+    return parts.join(' ').slice(0, limit);
+})(%d, %d);""" % (limit, max_elements)
+
+
+def _fulltext_schema(db):
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL DEFAULT '',
+            indexed_at REAL NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pages_by_time ON pages(indexed_at);
+    """)
+    # 日本語のように空白で区切らない文章も引けるよう trigram を使う (無い SQLite では unicode61)
+    try:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(title, body, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(title, body)")
+
+
+def _trim_fulltext(db, max_bytes):
+    # 保存している本文の合計が上限を超えたら古いページから消す
+    total, count = db.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM pages").fetchone()
+    if total <= max_bytes:
+        return
+    removed = 0
+    with db:
+        for page_id, size in db.execute("SELECT id, size FROM pages ORDER BY indexed_at").fetchall():
+            if total <= max_bytes * 0.9:
+                break
+            db.execute("DELETE FROM page_text WHERE rowid = ?", (page_id,))
+            db.execute("DELETE FROM pages WHERE id = ?", (page_id,))
+            total -= size
+            removed += 1
+        # 削除した分の索引セグメントを少しずつ併合し、空いたページを返す
+        db.execute("INSERT INTO page_text(page_text, rank) VALUES ('merge', 500)")
+    db.execute("PRAGMA incremental_vacuum")
+
+
+def run_fulltext_indexer(path, max_mb=FULLTEXT_MAX_MB):
+    # 別プロセスで動く索引係。標準入力から1行1ページの JSON を受け取って FTS5 に書き込み、
+    # 入力が閉じられたら終わる。GUI のプロセスでは索引の更新を一切しない
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    _fulltext_schema(db)
+    max_bytes = max_mb * 1024 * 1024
+    written = 0
+    stdin = open(sys.stdin.fileno(), encoding="utf-8", errors="replace", closefd=False)
+    for line in stdin:
+        try:
+            page = json.loads(line)
+            url, title, text = page["url"], page.get("title", ""), page["text"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        with db:
+            row = db.execute("SELECT id FROM pages WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                page_id = db.execute("INSERT INTO pages (url, title, indexed_at, size) VALUES (?, ?, ?, ?)",
+                                     (url, title, time.time(), len(text) + len(title))).lastrowid
+            else:
+                page_id = row[0]
+                db.execute("UPDATE pages SET title = ?, indexed_at = ?, size = ? WHERE id = ?",
+                           (title, time.time(), len(text) + len(title), page_id))
+                db.execute("DELETE FROM page_text WHERE rowid = ?", (page_id,))
+            db.execute("INSERT INTO page_text (rowid, title, body) VALUES (?, ?, ?)", (page_id, title, text))
+        written += 1
+        if written % FULLTEXT_TRIM_EVERY == 0:
+            _trim_fulltext(db, max_bytes)
+    _trim_fulltext(db, max_bytes)
+    db.close()
+    return 0
+
+
+class FullTextIndex(QObject):
+    # 索引係のプロセスを起こし、書き込みは専用スレッドからパイプに流す (パイプが詰まっても
+    # GUI スレッドは待たない)。検索は GUI 側の読み取り専用の接続で行う
+    def __init__(self, path=FULLTEXT_DB):
+        super().__init__()
+        self.path = os.path.abspath(path)
+        self.queue = queue.Queue(maxsize=FULLTEXT_QUEUE_LIMIT)
+        self.process = None
+        self.reader = None
+        self.trigram = None
+        self.thread = threading.Thread(target=self.feed, name="orb-fulltext", daemon=True)
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--fulltext-indexer", self.path],
+                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"Full-text indexer unavailable: {e}")
+            return
+        self.thread.start()
+
+    def submit(self, url, title, text):
+        if self.process is None:
+            return
+        try:
+            self.queue.put_nowait(json.dumps({"url": url, "title": title, "text": text}, ensure_ascii=False) + "\n")
+        except queue.Full:
+            pass
+
+    def feed(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            try:
+                self.process.stdin.write(line.encode("utf-8"))
+                self.process.stdin.flush()
+            except (OSError, ValueError) as e:
+                print(f"Full-text indexer stopped: {e}")
+                return
+        self.process.stdin.close()
+
+    def close(self, timeout=5):
+        if self.process is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def read_connection(self):
+        if self.reader is None:
+            if not os.path.exists(self.path):
+                return None
+            self.reader = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            sql = self.reader.execute("SELECT sql FROM sqlite_master WHERE name = 'page_text'").fetchone()
+            self.trigram = sql is not None and "trigram" in sql[0]
+        return self.reader
+
+    def search(self, text, limit=FULLTEXT_RESULTS):
+        db = self.read_connection()
+        if db is None:
+            return []
+        # 語ごとに引用して AND でつなぐ。trigram では3文字未満の語は引けないので外す
+        terms = [term for term in text.split() if not self.trigram or len(term) >= 3]
+        if not terms:
+            return []
+        query = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        with perf_trace.span("full-text query", "fulltext"):
+            try:
+                return db.execute(
+                    "SELECT pages.url, pages.title, snippet(page_text, 1, '[', ']', '…', 12) FROM page_text"
+                    " JOIN pages ON pages.id = page_text.rowid WHERE page_text MATCH ? ORDER BY rank LIMIT ?",
+                    (query, limit)).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"An error occurred: {e}")
+                return []
+
+
+class PageTextExtractor(QObject):
+    # 読み込みが終わったページを順番待ちにし、一定間隔で1ページずつ本文を取り出す
+    def __init__(self, index, interval_ms=FULLTEXT_EXTRACT_INTERVAL_MS):
+        super().__init__()
+        self.index = index
+        self.waiting = collections.OrderedDict()
+        self.recent = collections.OrderedDict()
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.extract_next)
+
+    def page_loaded(self, view):
+        url = view.url().toString()
+        if not url.startswith(("http://", "https://")):
+            return
+        indexed_at = self.recent.get(url)
+        if indexed_at is not None and time.monotonic() - indexed_at < FULLTEXT_REINDEX_AFTER:
+            return
+        self.waiting[view] = None
+        self.waiting.move_to_end(view)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def forget(self, view):
+        self.waiting.pop(view, None)
+
+    def extract_next(self):
+        if not self.waiting:
+            self.timer.stop()
+            return
+        view, _ = self.waiting.popitem(last=False)
+        page = view.page()
+        if page.lifecycleState() != QWebEnginePage.LifecycleState.Active:
+            return
+        url = view.url().toString()
+        self.recent[url] = time.monotonic()
+        self.recent.move_to_end(url)
+        if len(self.recent) > FULLTEXT_RECENT_URLS:
+            self.recent.popitem(last=False)
+        page.runJavaScript(page_text_js(), QWebEngineScript.ApplicationWorld,
+                           lambda text, url=url, title=page.title(): self.extracted(url, title, text))
+
+    def extracted(self, url, title, text):
+        with perf_trace.span("page text extracted", "fulltext"):
+            if isinstance(text, str) and text.strip():
+                self.index.submit(url, title, text)
+
+
+class FullTextSearchDialog(QDialog):
+    def __init__(self, parent, index):
+        super().__init__(parent)
+        self.setWindowTitle("ページ内容を検索")
+        self.resize(640, 480)
+        self.index = index
+        self.selected_url = None
+        self.search = QLineEdit()
+        self.search.setPlaceholderText("読んだページの本文から検索")
+        self.results = QListWidget()
+        self.results.setWordWrap(True)
+        self.results.itemActivated.connect(self.choose)
+        self.status = QLabel()
+        # 入力のたびに引かず、打ち終わりを待ってから検索する
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(150)
+        self.timer.timeout.connect(self.run_query)
+        self.search.textChanged.connect(self.timer.start)
+        self.search.returnPressed.connect(lambda: self.results.count() and self.choose(self.results.item(0)))
+        layout = QVBoxLayout()
+        layout.addWidget(self.search)
+        layout.addWidget(self.results)
+        layout.addWidget(self.status)
+        self.setLayout(layout)
+
+    def run_query(self):
+        start = time.perf_counter()
+        rows = self.index.search(self.search.text())
+        elapsed = (time.perf_counter() - start) * 1000
+        self.results.clear()
+        for url, title, snippet in rows:
+            item = QListWidgetItem(f"{title or url}\n{snippet}")
+            item.setToolTip(url)
+            item.setData(Qt.ItemDataRole.UserRole, url)
+            self.results.addItem(item)
+        self.status.setText(f"{len(rows)} 件 ({elapsed:.1f} ms)")
+
+    def choose(self, item):
+        self.selected_url = item.data(Qt.ItemDataRole.UserRole)
+        self.accept()
+
+
+def split_mhtml(data):
+    # MHTML を「先頭のヘッダー・境界・各パートのヘッダーと本文・末尾」に分ける。
+    # 本文だけを共有ストアに入れ、組み立て直すと元のバイト列に戻る
+    end = data.find(b"\r\n\r\n")
+    header = re.sub(rb"\r\n[ \t]+", b" ", data[:end]) if end != -1 else b""
+    match = re.search(rb'boundary="?([^";\r\n]+)"?', header, re.IGNORECASE)
+    if match is None:
+        return data[:0], None, [(b"", data)], b""
+    delimiter = b"--" + match.group(1)
+    pieces = data.split(delimiter)
+    if len(pieces) < 3:
+        return data[:0], None, [(b"", data)], b""
+    parts = []
+    for piece in pieces[1:-1]:
+        split = piece.find(b"\r\n\r\n")
+        if split == -1:
+            parts.append((piece, b""))
+        else:
+            parts.append((piece[:split + 4], piece[split + 4:]))
+    return pieces[0], match.group(1), parts, pieces[-1]
+
+
+def join_mhtml(preamble, boundary, parts, epilogue):
+    if boundary is None:
+        return b"".join(body for _, body in parts)
+    delimiter = b"--" + boundary
+    return preamble + b"".join(delimiter + headers + body for headers, body in parts) + delimiter + epilogue
+
+
+class SnapshotStore(QObject):
+    # オフライン保存したページの置き場。MHTML をパートに分け、本文は内容のハッシュで
+    # 一度だけ圧縮して保存する (同じ CSS・スクリプト・画像はページをまたいで共有される)。
+    # 参照数を数え、合計が上限を超えたら最後に開いたのが古いスナップショットから消す
+    saved = Signal(str)
+    stale = Signal(str)
+
+    def __init__(self, profile, runner, directory=SNAPSHOT_DIR, max_mb=SNAPSHOT_MAX_MB):
+        super().__init__()
+        self.runner = runner
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.revalidate = True
+        for name in ("objects", "incoming", "open"):
+            os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+        try:
+            import zstandard
+            self.zstd = zstandard
+        except ImportError:
+            self.zstd = None
+        # 書き込みは別スレッドで行うので、接続は鍵をかけて共有する
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.directory, "snapshots.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                url TEXT PRIMARY KEY,
+                title TEXT NOT NULL DEFAULT '',
+                manifest BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                saved_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            );
+        """)
+        self.urls = {url for url, in self.db.execute("SELECT url FROM snapshots")}
+        self.capturing = {}
+        self.read_latencies = collections.deque(maxlen=SNAPSHOT_LATENCY_SAMPLES)
+        profile.downloadRequested.connect(self.download_requested)
+
+    def has(self, url):
+        return url in self.urls
+
+    def capture(self, view):
+        url = view.url().toString()
+        if not url.startswith(("http://", "https://")):
+            return False
+        path = os.path.join(self.directory, "incoming", f"{uuid.uuid4().hex}.mhtml")
+        self.capturing[path] = (url, view.page().title())
+        view.page().save(path, QWebEngineDownloadRequest.SavePageFormat.MimeHtmlSaveFormat)
+        return True
+
+    def download_requested(self, download):
+        if not download.isSavePageDownload():
+            return
+        path = os.path.abspath(os.path.join(download.downloadDirectory(), download.downloadFileName()))
+        if path not in self.capturing:
+            return
+        if download.state() == QWebEngineDownloadRequest.DownloadState.DownloadRequested:
+            download.accept()
+        download.isFinishedChanged.connect(lambda download=download, path=path: self.capture_finished(download, path))
+
+    def capture_finished(self, download, path):
+        url, title = self.capturing.pop(path)
+        if download.state() != QWebEngineDownloadRequest.DownloadState.DownloadCompleted:
+            print(f"Snapshot failed: {download.interruptReasonString()}")
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        self.runner.submit(self.in_thread(self.ingest, url, title, path), self.ingested)
+
+    async def in_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def ingested(self, url):
+        self.saved.emit(url)
+        if self.revalidate:
+            self.runner.submit(self.fetch_validators(url))
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def compress(self, data):
+        if self.zstd is not None:
+            return b"Z" + self.zstd.ZstdCompressor(level=SNAPSHOT_ZSTD_LEVEL).compress(data)
+        return b"D" + zlib.compress(data, SNAPSHOT_ZLIB_LEVEL)
+
+    def decompress(self, data):
+        if data[:1] == b"Z":
+            if self.zstd is None:
+                raise OSError("snapshot blob needs the zstandard package")
+            return self.zstd.ZstdDecompressor().decompress(data[1:])
+        return zlib.decompress(data[1:])
+
+    def ingest(self, url, title, path):
+        with perf_trace.span("snapshot ingest", "snapshots"):
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+            preamble, boundary, parts, epilogue = split_mhtml(data)
+            entries = []
+            blobs = {}
+            for headers, body in parts:
+                digest = hashlib.sha256(body).hexdigest()
+                entries.append((headers, digest))
+                blobs[digest] = body
+            manifest = marshal.dumps((preamble, boundary, entries, epilogue))
+            with self.lock, self.db:
+                for digest, body in blobs.items():
+                    if self.db.execute("UPDATE blobs SET refs = refs + 1 WHERE digest = ?", (digest,)).rowcount:
+                        continue
+                    blob = self.compress(body)
+                    target = self.blob_path(digest)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with open(target + ".tmp", "wb") as f:
+                        f.write(blob)
+                    os.replace(target + ".tmp", target)
+                    self.db.execute("INSERT INTO blobs (digest, size, stored_size, refs) VALUES (?, ?, ?, 1)",
+                                    (digest, len(body), len(blob)))
+                # 取り直したときは新しい参照を足してから古い方を外すので、共有部分は書き直さない
+                self.release_locked(url)
+                now = time.time()
+                self.db.execute("INSERT INTO snapshots (url, title, manifest, size, saved_at, used_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", (url, title, manifest, len(data), now, now))
+                self.urls.add(url)
+                self.evict_locked(keep=url)
+            return url
+
+    def release_locked(self, url):
+        row = self.db.execute("SELECT manifest FROM snapshots WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM snapshots WHERE url = ?", (url,))
+        self.urls.discard(url)
+        for digest in {digest for _, digest in marshal.loads(row[0])[2]}:
+            self.db.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (digest,))
+            if self.db.execute("DELETE FROM blobs WHERE digest = ? AND refs <= 0", (digest,)).rowcount:
+                try:
+                    os.remove(self.blob_path(digest))
+                except OSError:
+                    pass
+        try:
+            os.remove(self.open_path(url))
+        except OSError:
+            pass
+
+    def evict_locked(self, keep=None):
+        while self.db.execute("SELECT COALESCE(SUM(stored_size), 0) FROM blobs").fetchone()[0] > self.max_bytes:
+            row = self.db.execute("SELECT url FROM snapshots WHERE url IS NOT ? ORDER BY used_at LIMIT 1",
+                                  (keep,)).fetchone()
+            if row is None:
+                break
+            self.release_locked(row[0])
+
+    def remove(self, url):
+        with self.lock, self.db:
+            self.release_locked(url)
+
+    def open_path(self, url):
+        return os.path.join(self.directory, "open", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".mhtml")
+
+    def materialize(self, url):
+        # 共有ストアから MHTML を組み立て直し、file:// で開けるように書き出す
+        start = time.perf_counter()
+        with perf_trace.span("snapshot read", "snapshots"):
+            with self.lock:
+                row = self.db.execute("SELECT manifest FROM snapshots WHERE url = ?", (url,)).fetchone()
+                if row is None:
+                    return None
+                with self.db:
+                    self.db.execute("UPDATE snapshots SET used_at = ? WHERE url = ?", (time.time(), url))
+                preamble, boundary, entries, epilogue = marshal.loads(row[0])
+                # 追い出しが途中でパートを消さないよう、ファイルは鍵を持ったまま読み切る (展開は鍵の外で行う)
+                stored = {}
+                for _, digest in entries:
+                    if digest not in stored:
+                        with open(self.blob_path(digest), "rb") as f:
+                            stored[digest] = f.read()
+            bodies = {digest: self.decompress(blob) for digest, blob in stored.items()}
+            parts = [(headers, bodies[digest]) for headers, digest in entries]
+            path = self.open_path(url)
+            with open(path + ".tmp", "wb") as f:
+                f.write(join_mhtml(preamble, boundary, parts, epilogue))
+            os.replace(path + ".tmp", path)
+        self.read_latencies.append(time.perf_counter() - start)
+        return path
+
+    def open(self, url, callback):
+        # ディスクからすぐに開き、有効なら裏でサーバーに変わっていないか問い合わせる
+        def opened(path):
+            if path is None:
+                return
+            callback(path)
+            if self.revalidate:
+                self.runner.submit(self.check_fresh(url), lambda fresh: fresh is False and self.stale.emit(url))
+        self.runner.submit(self.in_thread(self.materialize, url), opened)
+
+    async def head(self, url, headers=None):
+        session = await self.runner.get_session()
+        async with session.head(url, headers=headers or {}, allow_redirects=True) as response:
+            return response.status, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    async def fetch_validators(self, url):
+        _, etag, last_modified = await self.head(url)
+        with self.lock, self.db:
+            self.db.execute("UPDATE snapshots SET etag = ?, last_modified = ? WHERE url = ?",
+                            (etag, last_modified, url))
+
+    async def check_fresh(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified FROM snapshots WHERE url = ?", (url,)).fetchone()
+        if row is None or not any(row):
+            return None
+        headers = {}
+        if row[0]:
+            headers["If-None-Match"] = row[0]
+        if row[1]:
+            headers["If-Modified-Since"] = row[1]
+        status, _, _ = await self.head(url, headers)
+        return status == 304
+
+    def stats(self):
+        with self.lock:
+            snapshots, logical = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM snapshots").fetchone()
+            unique, stored = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs").fetchone()
+        latencies = sorted(self.read_latencies)
+        return {
+            "snapshots": snapshots,
+            "logical_bytes": logical,
+            "unique_bytes": unique,
+            "stored_bytes": stored,
+            "dedup_ratio": logical / unique if unique else 1.0,
+            "compression_ratio": unique / stored if stored else 1.0,
+            "read_ms_p50": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+            "read_ms_p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+        }
+
+
+class FaviconCache(QObject):
+    iconReady = Signal(str, object)
+
+    def __init__(self, runner, directory=FAVICON_DIR):
+        super().__init__()
+        self.runner = runner
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.icons = {}
+        self.pending = set()
+        # start() までは取得を始めず、起動中の要求はここに貯めておく
+        self.waiting = []
+        self.started = False
+        self.semaphore = None
+        self.save_timer = QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.timeout.connect(self.save_index)
+
+    @staticmethod
+    def origin(url):
+        qurl = QUrl(url)
+        if qurl.scheme() not in ("http", "https") or not qurl.host():
+            return None
+        port = qurl.port()
+        return f"{qurl.scheme()}://{qurl.host()}" + (f":{port}" if port != -1 else "")
+
+    def icon(self, url):
+        origin = self.origin(url)
+        if origin is None:
+            return None
+        icon = self.icons.get(origin)
+        if icon is None and origin in self.index:
+            pixmap = QPixmap(os.path.join(self.directory, self.index[origin] + ".png"))
+            if pixmap.isNull():
+                del self.index[origin]
+                return None
+            icon = self.icons[origin] = QIcon(pixmap)
+        return icon
+
+    def store_icon(self, url, icon):
+        origin = self.origin(url)
+        if origin is None or icon.isNull():
+            return
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        icon.pixmap(32, 32).save(buffer, "PNG")
+        buffer.close()
+        self.icons[origin] = icon
+        if self.store_bytes(origin, bytes(data)):
+            self.iconReady.emit(origin, icon)
+
+    def store_bytes(self, origin, data):
+        # 同じアイコンを使うオリジンは一つのファイルを共有する
+        digest = hashlib.sha1(data).hexdigest()
+        if self.index.get(origin) == digest:
+            return False
+        path = os.path.join(self.directory, digest + ".png")
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        self.index[origin] = digest
+        self.save_timer.start(2000)
+        return True
+
+    def save_index(self):
+        with open(self.index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def request(self, url):
+        origin = self.origin(url)
+        if origin is None or origin in self.index or origin in self.pending:
+            return
+        self.pending.add(origin)
+        if not self.started:
+            self.waiting.append(origin)
+            return
+        self.runner.submit(self.fetch(origin), lambda data, origin=origin: self.fetched(origin, data))
+
+    def start(self):
+        self.started = True
+        for origin in self.waiting:
+            self.runner.submit(self.fetch(origin), lambda data, origin=origin: self.fetched(origin, data))
+        self.waiting = []
+
+    async def fetch(self, origin):
+        import aiohttp
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(FAVICON_FETCH_WORKERS)
+        async with self.semaphore:
+            session = await self.runner.get_session()
+            try:
+                async with session.get(origin + "/favicon.ico", timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status != 200:
+                        return None
+                    return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None
+
+    def fetched(self, origin, data):
+        self.pending.discard(origin)
+        if not data:
+            return
+        pixmap = QPixmap()
+        if not pixmap.loadFromData(data):
+            return
+        self.store_icon(origin, QIcon(pixmap))
+
+
+class BookmarkStore:
+    def __init__(self, path=BOOKMARKS_DB):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.create_schema()
+        self.migrate_xml()
+
+    def create_schema(self):
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS folders (
+                id INTEGER PRIMARY KEY,
+                parent_id INTEGER REFERENCES folders(id) ON DELETE CASCADE,
+                name TEXT NOT NULL,
+                position INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS bookmarks (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                title TEXT NOT NULL DEFAULT '',
+                folder_id INTEGER REFERENCES folders(id) ON DELETE CASCADE,
+                position INTEGER NOT NULL DEFAULT 0,
+                added_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bookmarks_by_folder ON bookmarks(folder_id, position);
+        """)
+
+    def migrate_xml(self, path="shortcuts.xml"):
+        # 旧形式の shortcuts.xml は一度だけ取り込み、取り込んだ後は名前を変えて残す
+        if not os.path.exists(path):
+            return
+        try:
+            root = ET.parse(path).getroot()
+        except ET.ParseError as e:
+            print(f"An error occurred: {e}")
+            return
+        items = []
+        for shortcut in root.findall("shortcut"):
+            url = shortcut.findtext("url")
+            if url:
+                items.append((url, shortcut.findtext("title") or url))
+        self.add_many(items)
+        os.replace(path, path + ".migrated")
+
+    def next_position(self, folder_id):
+        row = self.db.execute("SELECT MAX(position) FROM bookmarks WHERE folder_id IS ?", (folder_id,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def add(self, url, title, folder_id=None):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO bookmarks (url, title, folder_id, position, added_at) VALUES (?, ?, ?, ?, ?)",
+                (url, title, folder_id, self.next_position(folder_id), time.time()))
+        return cursor.rowcount == 1
+
+    def add_many(self, items, folder_id=None):
+        position = self.next_position(folder_id)
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO bookmarks (url, title, folder_id, position, added_at) VALUES (?, ?, ?, ?, ?)",
+                ((url, title, folder_id, position + i, now) for i, (url, title) in enumerate(items)))
+
+    def remove(self, url):
+        with self.db:
+            self.db.execute("DELETE FROM bookmarks WHERE url = ?", (url,))
+
+    def contains(self, url):
+        return self.db.execute("SELECT 1 FROM bookmarks WHERE url = ?", (url,)).fetchone() is not None
+
+    def rename(self, url, title):
+        with self.db:
+            self.db.execute("UPDATE bookmarks SET title = ? WHERE url = ?", (title, url))
+
+    def move(self, url, folder_id, position):
+        with self.db:
+            self.db.execute("UPDATE bookmarks SET position = position + 1 WHERE folder_id IS ? AND position >= ?",
+                            (folder_id, position))
+            self.db.execute("UPDATE bookmarks SET folder_id = ?, position = ? WHERE url = ?", (folder_id, position, url))
+
+    def create_folder(self, name, parent_id=None):
+        with self.db:
+            row = self.db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM folders WHERE parent_id IS ?",
+                                  (parent_id,)).fetchone()
+            cursor = self.db.execute("INSERT INTO folders (parent_id, name, position) VALUES (?, ?, ?)",
+                                     (parent_id, name, row[0]))
+        return cursor.lastrowid
+
+    def remove_folder(self, folder_id):
+        with self.db:
+            self.db.execute("DELETE FROM folders WHERE id = ?", (folder_id,))
+
+    def folders(self):
+        # 親フォルダーが必ず先に来るよう、深さ順に並べる
+        return self.db.execute("""
+            WITH RECURSIVE tree(id, parent_id, name, position, depth) AS (
+                SELECT id, parent_id, name, position, 0 FROM folders WHERE parent_id IS NULL
+                UNION ALL
+                SELECT f.id, f.parent_id, f.name, f.position, tree.depth + 1
+                FROM folders f JOIN tree ON f.parent_id = tree.id
+            )
+            SELECT id, parent_id, name FROM tree ORDER BY depth, position
+        """).fetchall()
+
+    def all(self):
+        return self.db.execute(
+            "SELECT url, title, folder_id FROM bookmarks ORDER BY folder_id IS NOT NULL, folder_id, position").fetchall()
+
+
+class BookmarkAction(QAction):
+    saveOfflineRequested = Signal(str)
+
+    def __init__(self, title, url, store, parent, snapshots=None):
+        super().__init__(title, parent)
+        self.url = url
+        self.store = store
+        self.snapshots = snapshots
+
+    def showContextMenu(self, point):
+        contextMenu = QMenu(self.parent())
+        deleteAction = QAction("削除", self)
+        deleteAction.triggered.connect(self.deleteBookmark)
+        contextMenu.addAction(deleteAction)
+        if self.snapshots is not None:
+            saveAction = QAction("オフライン用に保存", self)
+            saveAction.triggered.connect(lambda: self.saveOfflineRequested.emit(self.url))
+            contextMenu.addAction(saveAction)
+            if self.snapshots.has(self.url):
+                removeSnapshotAction = QAction("オフライン版を削除", self)
+                removeSnapshotAction.triggered.connect(lambda: self.snapshots.remove(self.url))
+                contextMenu.addAction(removeSnapshotAction)
+        contextMenu.exec(point)
+
+    @perf_trace.traced("bookmark delete", "bookmarks")
+    def deleteBookmark(self):
+        self.store.remove(self.url)
+        for widget in self.associatedObjects():
+            if isinstance(widget, QWidget):
+                widget.removeAction(self)
+        self.deleteLater()
+
+class StallWatchdog(QObject):
+    # GUI スレッドのタイマーが心拍を打ち、別スレッドが途絶えた時間を見張る。閾値を超えたら
+    # その瞬間のメインスレッドの Python スタックを取って記録する
+    def __init__(self, trace, threshold_ms=STALL_THRESHOLD_MS, interval_ms=WATCHDOG_HEARTBEAT_MS):
+        super().__init__()
+        self.trace = trace
+        self.threshold = threshold_ms / 1000
+        self.gui_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.captured = None
+        self.stalls = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.beat)
+        self.timer.start(interval_ms)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name="orb-watchdog", daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        now = time.perf_counter()
+        last = self.last_beat
+        self.last_beat = now
+        if now - last > self.threshold:
+            self.stalls += 1
+            stack = self.captured[1] if self.captured and self.captured[0] == last else ""
+            self.trace.record("event loop stall", "watchdog", last, now, {"stack": stack}, self.gui_thread_id)
+
+    def watch(self):
+        while not self.stop_event.wait(self.threshold / 4):
+            last = self.last_beat
+            stalled = time.perf_counter() - last
+            if stalled <= self.threshold or (self.captured and self.captured[0] == last):
+                continue
+            frame = sys._current_frames().get(self.gui_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self.captured = (last, stack)
+            self.trace.instant("stall detected", "watchdog", {"stalled_ms": stalled * 1000, "stack": stack},
+                               self.gui_thread_id)
+            print(f"GUI thread stalled for {stalled * 1000:.0f} ms:\n{stack}", file=sys.stderr)
+
+    def stop(self):
+        self.timer.stop()
+        self.stop_event.set()
+
+
+class MemorySaver(QObject):
+    def __init__(self, tabs):
+        super().__init__()
+        self.tabs = tabs
+        self.tabs.currentChanged.connect(self.save_memory)
+        self.memory_saver_enabled = False
+        self.memory_budget_mb = MEMORY_SAVER_BUDGET_MB
+        self.freeze_after = MEMORY_SAVER_FREEZE_AFTER
+        self.discard_after = MEMORY_SAVER_DISCARD_AFTER
+        self.telemetry = None
+        # タブの位置は閉じたり並べ替えたりで変わるので、ビューそのものをキーにする
+        self.last_access_times = {}
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.check_inactive_tabs)
+        self.timer.start(30000)  # 30秒ごとにチェック
+
+    def views(self):
+        views = []
         for i in range(self.tabs.count()):
-            if i != self.tabs.currentIndex():
-                last_access_time = self.last_access_times.get(i, current_time)
-                if last_access_time.secsTo(current_time) > 600:  # 10分以上経過
-                    self.tabs.widget(i).setVisible(False)
+            widget = self.tabs.widget(i)
+            if isinstance(widget, QWebEngineView):
+                views.append(widget)
+        return views
+
+    def tab_memory(self, view):
+        if self.telemetry is not None:
+            memory = self.telemetry.memory_mb(view)
+            if memory is not None:
+                return memory
+        return ESTIMATED_TAB_MEMORY_MB
+
+    def save_memory(self, index):
+        view = self.tabs.widget(index)
+        if not isinstance(view, QWebEngineView):
+            return
+        self.last_access_times[view] = time.monotonic()
+        if view.page().lifecycleState() != QWebEnginePage.LifecycleState.Active:
+            view.page().setLifecycleState(QWebEnginePage.LifecycleState.Active)
+
+    def forget(self, view):
+        self.last_access_times.pop(view, None)
+
+    def toggle_memory_saver(self, enabled):
+        self.memory_saver_enabled = enabled
+        if not enabled:
+            # 破棄したタブは選択されたときに読み直すので、凍結だけを解除する
+            for view in self.views():
+                if view.page().lifecycleState() == QWebEnginePage.LifecycleState.Frozen:
+                    view.page().setLifecycleState(QWebEnginePage.LifecycleState.Active)
+        self.save_memory(self.tabs.currentIndex())
+
+    def can_suspend(self, view, state):
+        # 推奨状態より深く落とすと入力中のフォームや再生中の音声が失われるので、
+        # Qt が勧める状態までしか進めない
+        if view is self.tabs.currentWidget():
+            return False
+        recommended = view.page().recommendedState()
+        if state == QWebEnginePage.LifecycleState.Discarded:
+            return recommended == QWebEnginePage.LifecycleState.Discarded
+        return recommended in (QWebEnginePage.LifecycleState.Frozen, QWebEnginePage.LifecycleState.Discarded)
+
+    def freeze(self, view):
+        if (self.can_suspend(view, QWebEnginePage.LifecycleState.Frozen)
+                and view.page().lifecycleState() == QWebEnginePage.LifecycleState.Active):
+            view.page().setLifecycleState(QWebEnginePage.LifecycleState.Frozen)
+
+    def discard(self, view):
+        if (self.can_suspend(view, QWebEnginePage.LifecycleState.Discarded)
+                and view.page().lifecycleState() != QWebEnginePage.LifecycleState.Discarded):
+            view.page().setLifecycleState(QWebEnginePage.LifecycleState.Discarded)
+            return True
+        return False
+
+    def check_inactive_tabs(self):
+        if not self.memory_saver_enabled:
+            return
+
+        now = time.monotonic()
+        views = self.views()
+        self.last_access_times = {view: self.last_access_times.get(view, now) for view in views}
+        live = [view for view in views if view.page().lifecycleState() != QWebEnginePage.LifecycleState.Discarded]
+        used = sum(self.tab_memory(view) for view in live)
+        # 最も長く使われていないタブから順に凍結・破棄する (LRU)
+        for view in sorted(live, key=self.last_access_times.get):
+            if view is self.tabs.currentWidget():
+                continue
+            idle = now - self.last_access_times[view]
+            if used > self.memory_budget_mb or idle > self.discard_after:
+                memory = self.tab_memory(view)
+                if self.discard(view):
+                    used -= memory
                 else:
-                    self.tabs.widget(i).setVisible(True)
+                    # 破棄を勧められていないページは、せめて凍結して CPU を止める
+                    self.freeze(view)
+            elif idle > self.freeze_after:
+                self.freeze(view)
 
 
-    
+class LazyTab(QWidget):
+    def __init__(self, url, title, history=""):
+        super().__init__()
+        self.url = url
+        self.title = title
+        self.history = history
+
+
+def format_tab_title(title):
+    return title[:7] if len(title) > 7 else title.ljust(7)
+
+
+class TabRegistry(QObject):
+    # タブごとに変わらない番号を振り、ビューの寿命とタブ表示の更新を一か所で受け持つ。
+    # タイトル・アイコン・URL の変化は貯めておき、1フレームに一度まとめて反映する
+    updated = Signal(object)
+    closed = Signal(object)
+
+    def __init__(self, tabs, interval=TAB_UPDATE_INTERVAL_MS):
+        super().__init__()
+        self.tabs = tabs
+        self.next_id = 1
+        self.ids = {}
+        self.widgets = {}
+        self.info = {}
+        self.dirty = set()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+
+    def register(self, widget):
+        tab_id = self.next_id
+        self.next_id += 1
+        self.ids[widget] = tab_id
+        self.widgets[tab_id] = widget
+        self.info[tab_id] = self.describe(widget)
+        return tab_id
+
+    def replace(self, old, new):
+        tab_id = self.ids.pop(old, None)
+        if tab_id is None:
+            return self.register(new)
+        self.ids[new] = tab_id
+        self.widgets[tab_id] = new
+        self.touch(new)
+        return tab_id
+
+    def id_of(self, widget):
+        return self.ids.get(widget)
+
+    def widget(self, tab_id):
+        return self.widgets.get(tab_id)
+
+    def describe(self, widget):
+        if isinstance(widget, LazyTab):
+            return widget.title, widget.url, self.tabs.tabIcon(self.tabs.indexOf(widget))
+        return widget.page().title(), widget.url().toString(), widget.icon()
+
+    def touch(self, widget):
+        tab_id = self.ids.get(widget)
+        if tab_id is None:
+            return
+        self.dirty.add(tab_id)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    @perf_trace.traced("tab update", "tabs")
+    def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        changed = set()
+        for tab_id in dirty:
+            widget = self.widgets.get(tab_id)
+            index = self.tabs.indexOf(widget) if widget is not None else -1
+            if index < 0:
+                continue
+            title, url, icon = self.info[tab_id] = self.describe(widget)
+            self.tabs.setTabText(index, format_tab_title(title or url))
+            self.tabs.setTabToolTip(index, title)
+            if not icon.isNull():
+                self.tabs.setTabIcon(index, icon)
+            changed.add(tab_id)
+        if changed:
+            self.updated.emit(changed)
+
+    def close(self, widget):
+        tab_id = self.ids.pop(widget, None)
+        if tab_id is not None:
+            del self.widgets[tab_id]
+            self.info.pop(tab_id, None)
+            self.dirty.discard(tab_id)
+        index = self.tabs.indexOf(widget)
+        if index >= 0:
+            self.tabs.removeTab(index)
+        self.closed.emit(widget)
+        widget.deleteLater()
+
+
+class TabListModel(QAbstractListModel):
+    SearchRole = Qt.ItemDataRole.UserRole + 1
+
+    def __init__(self, registry, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+        tabs = registry.tabs
+        self.rows = [tab_id for tab_id in (registry.id_of(tabs.widget(i)) for i in range(tabs.count())) if tab_id is not None]
+        self.positions = {tab_id: row for row, tab_id in enumerate(self.rows)}
+        registry.updated.connect(self.refresh)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        tab_id = self.rows[index.row()]
+        title, url, icon = self.registry.info.get(tab_id, ("", "", QIcon()))
+        if role == Qt.ItemDataRole.DisplayRole:
+            return title or url
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return url
+        if role == Qt.ItemDataRole.DecorationRole:
+            return icon
+        if role == Qt.ItemDataRole.UserRole:
+            return tab_id
+        if role == self.SearchRole:
+            return f"{title} {url}"
+        return None
+
+    def refresh(self, tab_ids):
+        for tab_id in tab_ids:
+            row = self.positions.get(tab_id)
+            if row is not None:
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+
+
+class TabSwitcher(QDialog):
+    # 見えている行だけを描く QListView なので、数百タブでも開くのも絞り込むのも軽い
+    def __init__(self, parent, registry):
+        super().__init__(parent)
+        self.setWindowTitle("タブ")
+        self.resize(520, 480)
+        self.selected_id = None
+        self.model = TabListModel(registry, self)
+        self.proxy = QSortFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterRole(TabListModel.SearchRole)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.search = QLineEdit()
+        self.search.setPlaceholderText("タブを検索")
+        self.search.textChanged.connect(self.filter)
+        self.search.returnPressed.connect(lambda: self.choose(self.list.currentIndex()))
+        self.list = QListView()
+        self.list.setModel(self.proxy)
+        self.list.setUniformItemSizes(True)
+        self.list.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.list.activated.connect(self.choose)
+        layout = QVBoxLayout()
+        layout.addWidget(self.search)
+        layout.addWidget(self.list)
+        self.setLayout(layout)
+        current = self.model.positions.get(registry.id_of(registry.tabs.currentWidget()))
+        if current is not None:
+            self.list.setCurrentIndex(self.proxy.mapFromSource(self.model.index(current)))
+
+    def filter(self, text):
+        self.proxy.setFilterFixedString(text)
+        if self.proxy.rowCount():
+            self.list.setCurrentIndex(self.proxy.index(0, 0))
+
+    def keyPressEvent(self, event):
+        # 検索欄にフォーカスがあっても上下キーで候補を選べるようにする
+        if event.key() in (Qt.Key.Key_Up, Qt.Key.Key_Down, Qt.Key.Key_PageUp, Qt.Key.Key_PageDown):
+            QApplication.sendEvent(self.list, event)
+            return
+        super().keyPressEvent(event)
+
+    def choose(self, index):
+        if not index.isValid():
+            return
+        self.selected_id = index.data(Qt.ItemDataRole.UserRole)
+        self.accept()
+
+
+class SessionStore(QObject):
+    def __init__(self, tabs, path=SESSION_FILE):
+        super().__init__()
+        self.tabs = tabs
+        self.path = path
+        # 変更のあったタブだけを直列化し直し、書き込みはまとめて遅らせる
+        self.entries = {}
+        self.dirty = set()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.save)
+        self.tabs.currentChanged.connect(self.schedule)
+        self.tabs.tabBar().tabMoved.connect(self.schedule)
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def schedule(self, *args):
+        self.timer.start(SESSION_SAVE_DELAY_MS)
+
+    def mark_dirty(self, widget):
+        self.dirty.add(widget)
+        self.schedule()
+
+    def forget(self, widget):
+        self.entries.pop(widget, None)
+        self.dirty.discard(widget)
+        self.schedule()
+
+    def replace(self, old, new):
+        entry = self.entries.pop(old, None)
+        if entry is not None:
+            self.entries[new] = entry
+        self.dirty.discard(old)
+
+    def serialize(self, widget):
+        if isinstance(widget, LazyTab):
+            return {"url": widget.url, "title": widget.title, "history": widget.history}
+        history = ""
+        data = QByteArray()
+        stream = QDataStream(data, QIODevice.OpenModeFlag.WriteOnly)
+        try:
+            stream << widget.page().history()
+            history = base64.b64encode(bytes(data)).decode("ascii")
+        except (TypeError, AttributeError):
+            pass
+        return {"url": widget.url().toString(), "title": widget.page().title(), "history": history}
+
+    def restore_history(self, browser, history):
+        data = QByteArray(base64.b64decode(history))
+        stream = QDataStream(data, QIODevice.OpenModeFlag.ReadOnly)
+        try:
+            stream >> browser.page().history()
+        except (TypeError, AttributeError):
+            return False
+        return stream.status() == QDataStream.Status.Ok and browser.page().history().count() > 0
+
+    @perf_trace.traced("session save", "tabs")
+    def save(self):
+        widgets = [self.tabs.widget(i) for i in range(self.tabs.count())]
+        entries = {}
+        for widget in widgets:
+            entry = self.entries.get(widget)
+            if entry is None or widget in self.dirty:
+                entry = self.serialize(widget)
+            entries[widget] = entry
+        self.entries = entries
+        self.dirty.clear()
+        data = {"active": self.tabs.currentIndex(), "tabs": [entries[widget] for widget in widgets]}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class DownloadManager(QObject):
+    changed = Signal()
+
+    def __init__(self, profile, status, directory=DOWNLOAD_DIR):
+        super().__init__()
+        self.directory = directory
+        self.profile = profile
+        self.restart_page = None
+        profile.setDownloadPath(directory)
+        profile.downloadRequested.connect(self.request)
+        self.downloads = []
+        self.queued = collections.deque()
+        self.user_paused = set()
+        self.throttled = set()
+        self.max_concurrent = MAX_CONCURRENT_DOWNLOADS
+        self.bandwidth_limit = 0  # バイト/秒、0 は無制限
+        self.budget = 0
+        self.last_bytes = {}
+        self.speeds = {}
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(160)
+        self.progress_bar.hide()
+        status.addPermanentWidget(self.progress_bar)
+        # 進捗はチャンクごとではなく一定間隔でまとめて反映する
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+
+    def request(self, download):
+        if download.isSavePageDownload():
+            return
+        download.setDownloadDirectory(self.directory)
+        download.setDownloadFileName(download.suggestedFileName())
+        download.accept()
+        self.downloads.append(download)
+        download.stateChanged.connect(lambda state, download=download: self.state_changed(download))
+        if len(self.running()) > self.max_concurrent:
+            download.pause()
+            self.queued.append(download)
+        if not self.timer.isActive():
+            self.timer.start(DOWNLOAD_REFRESH_MS)
+        self.changed.emit()
+
+    def running(self):
+        return [download for download in self.downloads
+                if not download.isFinished()
+                and download.state() != QWebEngineDownloadRequest.DownloadState.DownloadInterrupted
+                and download not in self.queued and download not in self.user_paused]
+
+    def start_next(self):
+        while self.queued and len(self.running()) < self.max_concurrent:
+            download = self.queued.popleft()
+            if download not in self.throttled:
+                download.resume()
+        if not self.timer.isActive():
+            self.timer.start(DOWNLOAD_REFRESH_MS)
+
+    def state_changed(self, download):
+        if download.isFinished() or download.state() == QWebEngineDownloadRequest.DownloadState.DownloadInterrupted:
+            self.throttled.discard(download)
+            self.last_bytes.pop(download, None)
+            self.speeds.pop(download, None)
+            self.start_next()
+
+    def pause(self, download):
+        if download in self.queued:
+            self.queued.remove(download)
+        self.user_paused.add(download)
+        download.pause()
+        self.start_next()
+
+    def resume(self, download):
+        # resume() が効くのは一時停止中のものだけ。中断されたものは終了扱いなので最初から取り直す
+        if download.state() == QWebEngineDownloadRequest.DownloadState.DownloadInterrupted:
+            self.restart(download)
+            return
+        self.user_paused.discard(download)
+        if len(self.running()) >= self.max_concurrent:
+            if download not in self.queued:
+                self.queued.append(download)
+            return
+        download.resume()
+        if not self.timer.isActive():
+            self.timer.start(DOWNLOAD_REFRESH_MS)
+
+    def restart(self, download):
+        page = download.page()
+        if page is None:
+            # 元のタブが閉じられていても取り直せるよう、表示しないページを一つ持っておく
+            if self.restart_page is None:
+                self.restart_page = QWebEnginePage(self.profile, self)
+            page = self.restart_page
+        self.downloads.remove(download)
+        self.user_paused.discard(download)
+        page.download(download.url(), download.downloadFileName())
+        self.changed.emit()
+
+    def cancel(self, download):
+        if download in self.queued:
+            self.queued.remove(download)
+        self.user_paused.discard(download)
+        download.cancel()
+
+    @perf_trace.traced("download progress", "downloads")
+    def tick(self):
+        interval = DOWNLOAD_REFRESH_MS / 1000
+        received = 0
+        running = self.running()
+        for download in running:
+            current = download.receivedBytes()
+            delta = max(0, current - self.last_bytes.get(download, current))
+            self.last_bytes[download] = current
+            self.speeds[download] = delta / interval
+            received += delta
+        if self.bandwidth_limit:
+            # トークンバケツ: 使いすぎたら一時停止し、予算が戻ったら再開する
+            self.budget = min(self.budget + self.bandwidth_limit * interval - received, self.bandwidth_limit)
+            if self.budget < 0:
+                for download in running:
+                    if download not in self.throttled and not download.isPaused():
+                        self.throttled.add(download)
+                        download.pause()
+            elif self.throttled:
+                for download in list(self.throttled):
+                    self.throttled.discard(download)
+                    if download in running:
+                        download.resume()
+        elif self.throttled:
+            for download in list(self.throttled):
+                download.resume()
+            self.throttled.clear()
+        total = done = 0
+        for download in running + list(self.queued):
+            if download.totalBytes() > 0:
+                total += download.totalBytes()
+                done += download.receivedBytes()
+        if running or self.queued:
+            self.progress_bar.setValue(int(done / total * 100) if total else 0)
+            self.progress_bar.show()
+        else:
+            self.progress_bar.hide()
+            self.timer.stop()
+        self.changed.emit()
+
+
+class DownloadPanel(QDockWidget):
+    COLUMNS = ["ファイル", "進捗", "速度", "状態"]
+
+    def __init__(self, parent, manager, video_queue):
+        super().__init__("ダウンロード", parent)
+        self.manager = manager
+        self.row_downloads = []
+        self.pages = QTabWidget()
+        widget = QWidget()
+        layout = QVBoxLayout()
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        layout.addWidget(self.table)
+        button_layout = QHBoxLayout()
+        for label, handler in (("一時停止", self.manager.pause), ("再開", self.manager.resume), ("キャンセル", self.manager.cancel)):
+            button = QPushButton(label)
+            button.clicked.connect(lambda _, handler=handler: self.apply(handler))
+            button_layout.addWidget(button)
+        button_layout.addWidget(QLabel("同時ダウンロード数"))
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(1, 16)
+        self.concurrency_spin.setValue(self.manager.max_concurrent)
+        self.concurrency_spin.valueChanged.connect(self.set_max_concurrent)
+        button_layout.addWidget(self.concurrency_spin)
+        button_layout.addWidget(QLabel("帯域制限 (KB/s, 0 = なし)"))
+        self.bandwidth_spin = QSpinBox()
+        self.bandwidth_spin.setRange(0, 1000000)
+        self.bandwidth_spin.setSingleStep(100)
+        self.bandwidth_spin.valueChanged.connect(lambda value: setattr(self.manager, "bandwidth_limit", value * 1024))
+        button_layout.addWidget(self.bandwidth_spin)
+        layout.addLayout(button_layout)
+        widget.setLayout(layout)
+        self.pages.addTab(widget, "ファイル")
+        self.pages.addTab(VideoJobsView(video_queue), "動画")
+        self.setWidget(self.pages)
+        self.manager.changed.connect(self.refresh)
+
+    def set_max_concurrent(self, value):
+        self.manager.max_concurrent = value
+        self.manager.start_next()
+
+    def selected_downloads(self):
+        return [self.row_downloads[row] for row in {index.row() for index in self.table.selectedIndexes()}]
+
+    def apply(self, handler):
+        for download in self.selected_downloads():
+            handler(download)
+        self.refresh()
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        downloads = self.manager.downloads
+        if len(downloads) != self.table.rowCount():
+            self.table.setRowCount(len(downloads))
+        self.row_downloads = list(downloads)
+        for row, download in enumerate(downloads):
+            total = download.totalBytes()
+            progress = f"{download.receivedBytes() * 100 // total}%" if total > 0 else f"{download.receivedBytes() // 1024} KB"
+            speed = self.manager.speeds.get(download, 0)
+            if download in self.manager.queued:
+                state = "待機中"
+            elif download in self.manager.user_paused:
+                state = "一時停止"
+            elif download.state() == QWebEngineDownloadRequest.DownloadState.DownloadInterrupted:
+                state = "中断: " + download.interruptReasonString()
+            else:
+                state = download.state().name.replace("Download", "")
+            for column, text in enumerate((download.downloadFileName(), progress, f"{speed / 1024:.0f} KB/s", state)):
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QTableWidgetItem(text))
+                elif item.text() != text:
+                    item.setText(text)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+
+
+class VideoJob:
+    def __init__(self, url, job_id=None, state="queued", progress=0.0, filename="", error=""):
+        self.id = job_id or hashlib.sha1(f"{url}{time.time()}".encode()).hexdigest()[:12]
+        self.url = url
+        self.state = state
+        self.progress = progress
+        self.filename = filename
+        self.error = error
+        self.speed = 0
+        self.item = ""
+        self.cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {"id": self.id, "url": self.url, "state": self.state, "progress": self.progress,
+                "filename": self.filename, "error": self.error}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["url"], data.get("id"), data.get("state", "queued"), data.get("progress", 0.0),
+                   data.get("filename", ""), data.get("error", ""))
+
+
+class VideoDownloadQueue(QObject):
+    changed = Signal()
+
+    def __init__(self, directory=DOWNLOAD_DIR, path=VIDEO_JOBS_FILE, workers=VIDEO_DOWNLOAD_WORKERS):
+        super().__init__()
+        self.directory = directory
+        self.path = path
+        self.fragment_concurrency = VIDEO_FRAGMENT_CONCURRENCY
+        self.jobs = []
+        self.pending = queue.Queue()
+        # ワーカースレッドからの進捗はここに積み、GUI スレッドが一定間隔でまとめて取り出す
+        self.updates = collections.deque()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.drain)
+        self.load()
+        self.workers = [threading.Thread(target=self.work, name=f"orb-video-{i}", daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                jobs = [VideoJob.from_dict(data) for data in json.load(f)]
+        except (OSError, ValueError, KeyError):
+            return
+        for job in jobs:
+            if job.state in ("queued", "downloading"):
+                # 前回終了時に未完了だったジョブは最初からやり直す (yt-dlp が .part から再開する)
+                job.state = "queued"
+                self.enqueue(job)
+        self.jobs = jobs
+        if not self.pending.empty():
+            self.timer.start(VIDEO_PROGRESS_MS)
+
+    def save(self):
+        finished = [job for job in self.jobs if job.state == "finished"]
+        for job in finished[:-VIDEO_JOBS_KEPT]:
+            self.jobs.remove(job)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump([job.to_dict() for job in self.jobs], f, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+    def add(self, urls):
+        for url in urls:
+            job = VideoJob(url)
+            self.jobs.append(job)
+            self.enqueue(job)
+        self.save()
+        self.timer.start(VIDEO_PROGRESS_MS)
+        self.changed.emit()
+
+    def enqueue(self, job):
+        # キューには投入時の cancel_event も一緒に積む。待機中に取り消してから再試行すると
+        # 古い要素がキューに残るので、ワーカーは今の cancel_event と違うものを読み飛ばす
+        self.pending.put((job, job.cancel_event))
+
+    def cancel(self, job):
+        job.cancel_event.set()
+        if job.state == "queued":
+            job.state = "cancelled"
+            self.save()
+            self.changed.emit()
+
+    def retry(self, job):
+        if job.state in ("error", "cancelled"):
+            job.cancel_event = threading.Event()
+            job.state = "queued"
+            job.error = ""
+            self.enqueue(job)
+            self.save()
+            self.timer.start(VIDEO_PROGRESS_MS)
+            self.changed.emit()
+
+    def work(self):
+        while True:
+            entry = self.pending.get()
+            if entry is None:
+                return
+            job, cancel_event = entry
+            if cancel_event is not job.cancel_event or cancel_event.is_set():
+                continue
+            self.updates.append((job, {"state": "downloading"}))
+            import yt_dlp
+            try:
+                self.download(job)
+                self.updates.append((job, {"state": "finished", "progress": 1.0, "speed": 0}))
+            except yt_dlp.utils.DownloadCancelled:
+                self.updates.append((job, {"state": "cancelled", "speed": 0}))
+            except Exception as e:
+                self.updates.append((job, {"state": "error", "error": str(e), "speed": 0}))
+
+    def download(self, job):
+        import yt_dlp
+        last_update = [0.0]
+
+        def progress_hook(d):
+            if job.cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled()
+            now = time.monotonic()
+            if d["status"] == "downloading" and now - last_update[0] < VIDEO_PROGRESS_MS / 1000:
+                return
+            last_update[0] = now
+            total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
+            info = d.get("info_dict") or {}
+            changes = {
+                "filename": os.path.basename(d.get("filename") or ""),
+                "speed": d.get("speed") or 0,
+                "item": f"{info['playlist_index']}/{info.get('n_entries') or '?'}" if info.get("playlist_index") else "",
+            }
+            if total:
+                changes["progress"] = d.get("downloaded_bytes", 0) / total
+            self.updates.append((job, changes))
+
+        ydl_opts = {
+            'format': 'mp4',
+            'outtmpl': os.path.join(self.directory, '%(title)s [%(id)s].%(ext)s'),
+            'progress_hooks': [progress_hook],
+            'concurrent_fragment_downloads': self.fragment_concurrency,
+            'noplaylist': False,
+            'quiet': True,
+            'noprogress': True,
+        }
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([job.url])
+
+    @perf_trace.traced("video progress", "downloads")
+    def drain(self):
+        state_changed = False
+        while self.updates:
+            job, changes = self.updates.popleft()
+            if "state" in changes and changes["state"] != job.state:
+                state_changed = True
+            for name, value in changes.items():
+                setattr(job, name, value)
+        if state_changed:
+            self.save()
+        if not any(job.state in ("queued", "downloading") for job in self.jobs):
+            self.timer.stop()
+        self.changed.emit()
+
+    def shutdown(self):
+        for job in self.jobs:
+            job.cancel_event.set()
+        for _ in self.workers:
+            self.pending.put(None)
+        self.drain()
+
+
+class VideoJobsView(QWidget):
+    COLUMNS = ["URL", "ファイル", "進捗", "速度", "状態"]
+
+    def __init__(self, video_queue):
+        super().__init__()
+        self.queue = video_queue
+        layout = QVBoxLayout()
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
+        layout.addWidget(self.table)
+        button_layout = QHBoxLayout()
+        for label, handler in (("キャンセル", self.queue.cancel), ("再試行", self.queue.retry)):
+            button = QPushButton(label)
+            button.clicked.connect(lambda _, handler=handler: self.apply(handler))
+            button_layout.addWidget(button)
+        button_layout.addWidget(QLabel("フラグメント並列数"))
+        fragment_spin = QSpinBox()
+        fragment_spin.setRange(1, 32)
+        fragment_spin.setValue(self.queue.fragment_concurrency)
+        fragment_spin.valueChanged.connect(lambda value: setattr(self.queue, "fragment_concurrency", value))
+        button_layout.addWidget(fragment_spin)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+        self.queue.changed.connect(self.refresh)
+
+    def apply(self, handler):
+        jobs = self.queue.jobs
+        for row in {index.row() for index in self.table.selectedIndexes()}:
+            if row < len(jobs):
+                handler(jobs[row])
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        jobs = self.queue.jobs
+        self.table.setRowCount(len(jobs))
+        for row, job in enumerate(jobs):
+            state = job.state + (f" ({job.item})" if job.item else "") + (f": {job.error}" if job.error else "")
+            for column, text in enumerate((job.url, job.filename, f"{job.progress * 100:.0f}%",
+                                           f"{job.speed / 1024:.0f} KB/s", state)):
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QTableWidgetItem(text))
+                elif item.text() != text:
+                    item.setText(text)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+
+
+class TabTelemetry(QObject):
+    sampled = Signal()
+
+    def __init__(self, tabs, interval=TELEMETRY_INTERVAL_MS):
+        super().__init__()
+        self.tabs = tabs
+        self.samples = {}
+        self.previous_cpu = {}
+        self.log_file = None
+        self.enabled = os.path.exists("/proc/self/stat")
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if self.enabled else 4096
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if self.enabled else 100
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.sample)
+        if self.enabled:
+            self.timer.start(interval)
+
+    def read_process(self, pid):
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+        # プロセス名に空白や括弧が含まれても崩れないよう、最後の ")" の後から数える
+        fields = stat[stat.rfind(")") + 2:].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / self.clock_ticks
+        return rss_pages * self.page_size, cpu_seconds
+
+    def sample(self):
+        now = time.monotonic()
+        views_by_pid = {}
+        for i in range(self.tabs.count()):
+            view = self.tabs.widget(i)
+            if isinstance(view, QWebEngineView):
+                views_by_pid.setdefault(view.page().renderProcessPid(), []).append(view)
+        samples = {}
+        previous_cpu = {}
+        for pid, views in views_by_pid.items():
+            rss = cpu_percent = cpu_seconds = 0
+            if pid > 0:
+                try:
+                    rss, cpu_seconds = self.read_process(pid)
+                except (OSError, ValueError, IndexError):
+                    continue
+                previous = self.previous_cpu.get(pid)
+                if previous is not None and now > previous[1]:
+                    cpu_percent = (cpu_seconds - previous[0]) / (now - previous[1]) * 100
+                previous_cpu[pid] = (cpu_seconds, now)
+            # 同じレンダラーを共有するタブにはメモリーを等分して割り当てる
+            for view in views:
+                samples[view] = {
+                    "pid": pid,
+                    "rss_mb": rss / len(views) / (1024 * 1024),
+                    "process_rss_mb": rss / (1024 * 1024),
+                    "cpu_percent": cpu_percent,
+                    "cpu_seconds": cpu_seconds,
+                    "shared_with": len(views) - 1,
+                }
+        self.samples = samples
+        self.previous_cpu = previous_cpu
+        if self.log_file is not None:
+            self.write_samples(self.log_file)
+        self.sampled.emit()
+
+    def memory_mb(self, view):
+        sample = self.samples.get(view)
+        if sample is None or sample["pid"] <= 0:
+            return None
+        return sample["rss_mb"]
+
+    def write_samples(self, f):
+        timestamp = time.time()
+        for view, sample in self.samples.items():
+            record = dict(sample, time=timestamp, url=view.url().toString(), title=view.page().title(),
+                          state=view.page().lifecycleState().name)
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+
+    def start_logging(self, path):
+        self.log_file = open(path, "a", encoding="utf-8")
+
+    def dump_samples(self, path):
+        with open(path, "a", encoding="utf-8") as f:
+            self.write_samples(f)
+
+
+class TaskManagerDialog(QDialog):
+    COLUMNS = ["タブ", "PID", "メモリー (MB)", "CPU (%)", "状態"]
+
+    def __init__(self, parent, tabs, telemetry, memory_saver, preconnector=None, snapshots=None):
+        super().__init__(parent)
+        self.setWindowTitle("タスクマネージャー")
+        self.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+        self.resize(640, 360)
+        self.tabs = tabs
+        self.telemetry = telemetry
+        self.memory_saver = memory_saver
+        self.preconnector = preconnector
+        self.snapshots = snapshots
+        self.row_views = []
+        self.init_ui()
+        self.telemetry.sampled.connect(self.refresh)
+        self.refresh()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.table.setSortingEnabled(True)
+        layout.addWidget(self.table)
+        self.preconnect_label = QLabel()
+        layout.addWidget(self.preconnect_label)
+        self.snapshot_label = QLabel()
+        layout.addWidget(self.snapshot_label)
+        button_layout = QHBoxLayout()
+        discard_button = QPushButton("タブを破棄")
+        discard_button.clicked.connect(self.discard_selected)
+        kill_button = QPushButton("プロセスを終了")
+        kill_button.clicked.connect(self.kill_selected)
+        dump_button = QPushButton("JSON に書き出す")
+        dump_button.clicked.connect(self.dump)
+        button_layout.addWidget(discard_button)
+        button_layout.addWidget(kill_button)
+        button_layout.addWidget(dump_button)
+        if perf_trace.enabled:
+            trace_button = QPushButton("トレースを書き出す")
+            trace_button.clicked.connect(self.export_trace)
+            button_layout.addWidget(trace_button)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+    def refresh(self):
+        self.table.setSortingEnabled(False)
+        self.row_views = []
+        self.table.setRowCount(0)
+        for i in range(self.tabs.count()):
+            view = self.tabs.widget(i)
+            if not isinstance(view, QWebEngineView):
+                continue
+            sample = self.telemetry.samples.get(view, {})
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            title_item = QTableWidgetItem(view.page().title() or view.url().toString())
+            title_item.setData(Qt.ItemDataRole.UserRole, len(self.row_views))
+            self.row_views.append(view)
+            self.table.setItem(row, 0, title_item)
+            for column, value in ((1, sample.get("pid", 0)), (2, round(sample.get("rss_mb", 0.0), 1)),
+                                  (3, round(sample.get("cpu_percent", 0.0), 1))):
+                item = QTableWidgetItem()
+                item.setData(Qt.ItemDataRole.DisplayRole, value)
+                self.table.setItem(row, column, item)
+            self.table.setItem(row, 4, QTableWidgetItem(view.page().lifecycleState().name))
+        self.table.setSortingEnabled(True)
+        if self.preconnector is not None:
+            stats = self.preconnector.stats()
+            self.preconnect_label.setText(
+                f"先行接続: {stats['hits']}/{stats['issued']} 件が使われた ({stats['hit_rate']:.0%})、"
+                f"遷移 {stats['navigations']} 件")
+        if self.snapshots is not None:
+            stats = self.snapshots.stats()
+            self.snapshot_label.setText(
+                f"オフライン保存: {stats['snapshots']} 件、{stats['stored_bytes'] / 1048576:.1f} MB "
+                f"(重複排除 {stats['dedup_ratio']:.2f}x、圧縮 {stats['compression_ratio']:.2f}x)、"
+                f"読み出し p50 {stats['read_ms_p50']:.1f} ms / p95 {stats['read_ms_p95']:.1f} ms")
+
+    def selected_views(self):
+        views = []
+        for row in {index.row() for index in self.table.selectedIndexes()}:
+            views.append(self.row_views[self.table.item(row, 0).data(Qt.ItemDataRole.UserRole)])
+        return views
+
+    def discard_selected(self):
+        for view in self.selected_views():
+            self.memory_saver.discard(view)
+        self.refresh()
+
+    def kill_selected(self):
+        for view in self.selected_views():
+            pid = view.page().renderProcessPid()
+            if pid > 0:
+                try:
+                    os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+                except OSError as e:
+                    print(f"An error occurred: {e}")
+        self.refresh()
+
+    def dump(self):
+        path, _ = QFileDialog.getSaveFileName(self, "JSON に書き出す", "telemetry.jsonl", "JSON Lines (*.jsonl)")
+        if path:
+            self.telemetry.dump_samples(path)
+
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, "トレースを書き出す", "orb-trace.json", "Chrome trace (*.json)")
+        if path:
+            perf_trace.export(path)
+
+
+def style_injection_js(style_id, css, excluded_hosts=(), unhidden=None):
+    # DocumentCreation の時点では documentElement がまだ無いことがあるので、
+    # できるまで MutationObserver で待ってから <style> を差し込む。unhidden はホストごとに
+    # 取り除く規則の番号 (--orb-exception) で、番号付きの規則は末尾にまとまっている
+    return """(function() {
+    var excluded = new Set(%s);
+    var unhidden = %s;
+    var ids = new Set();
+    for (var host = location.hostname; host; host = host.indexOf('.') < 0 ? '' : host.slice(host.indexOf('.') + 1)) {
+        if (excluded.has(host)) return;
+        (unhidden[host] || []).forEach(function(id) { ids.add(String(id)); });
+    }
+    function inject() {
+        if (document.getElementById(%s)) return;
+        var style = document.createElement('style');
+        style.id = %s;
+        style.textContent = %s;
+        (document.head || document.documentElement).appendChild(style);
+        if (!ids.size || !style.sheet) return;
+        var rules = style.sheet.cssRules;
+        for (var i = rules.length - 1; i >= 0; i--) {
+            var id = rules[i].style ? rules[i].style.getPropertyValue('--orb-exception').trim() : '';
+            if (!id) break;
+            if (ids.has(id)) style.sheet.deleteRule(i);
+        }
+    }
+    if (document.documentElement) {
+        inject();
+    } else {
+        new MutationObserver(function(_, observer) {
+            if (!document.documentElement) return;
+            observer.disconnect();
+            inject();
+        }).observe(document, {childList: true});
+    }
+})();""" % (json.dumps(sorted(excluded_hosts)), json.dumps(unhidden or {}), json.dumps(style_id), json.dumps(style_id),
+            json.dumps(css))
+
+
+def style_removal_js(style_id):
+    return "(function() { var style = document.getElementById(%s); if (style) style.remove(); })();" % json.dumps(style_id)
+
 
 class DarkMode(QObject):
-    def __init__(self, tabs):
+    def __init__(self, tabs, profile):
         super().__init__()
         self.tabs = tabs
-        self.dark_mode_enabled = False
+        self.profile = profile
+        self.excluded_sites = set()
+        # 切り替えのたびに世代を進め、開いているタブは表示されたときに追いつかせる
+        self.generation = 0
+        self.dark_mode_enabled = bool(profile.scripts().find(DARK_MODE_SCRIPT))
+
+    def build_script(self):
+        script = QWebEngineScript()
+        script.setName(DARK_MODE_SCRIPT)
+        script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+        script.setWorldId(QWebEngineScript.ApplicationWorld)
+        script.setRunsOnSubFrames(True)
+        script.setSourceCode(style_injection_js(DARK_MODE_STYLE_ID, DARK_MODE_CSS, self.excluded_sites))
+        return script
+
+    def install_script(self):
+        scripts = self.profile.scripts()
+        for script in scripts.find(DARK_MODE_SCRIPT):
+            scripts.remove(script)
+        if self.dark_mode_enabled:
+            scripts.insert(self.build_script())
+        self.generation += 1
 
     def toggle_dark_mode(self, enabled):
+        # プロファイルのスクリプトを差し替えるだけなので、タブ数に関係なく一定の手間で済む。
+        # 以降に作られるドキュメントは最初の描画から暗い配色になる
+        if enabled == self.dark_mode_enabled:
+            return
         self.dark_mode_enabled = enabled
-        for i in range(self.tabs.count()):
-            web_view = self.tabs.widget(i)
-            if enabled:
-                web_view.page().setBackgroundColor(Qt.black)
-                self.apply_dark_mode_js(web_view)
-            
-            else:
-                web_view.page().setBackgroundColor(Qt.white)
-                self.remove_dark_mode_js(web_view)
+        self.install_script()
+        self.sync(self.tabs.currentWidget())
+
+    def set_excluded_sites(self, sites):
+        if isinstance(sites, str):
+            sites = re.split(r"[\s,]+", sites)
+        excluded = {site.strip().lower().lstrip(".") for site in sites if site.strip()}
+        if excluded == self.excluded_sites:
+            return
+        self.excluded_sites = excluded
+        if self.dark_mode_enabled:
+            self.install_script()
+            self.sync(self.tabs.currentWidget())
+
+    def is_excluded(self, url):
+        return any(suffix in self.excluded_sites for suffix in _host_suffixes(QUrl(url).host().lower()))
 
-    def apply_dark_mode_js(self, web_view):
-        js_code = """
-        document.body.style.backgroundColor = 'black';
-        document.body.style.color = 'white';
-        """
-        web_view.page().runJavaScript(js_code)
+    def sync(self, web_view):
+        # 切り替え前から開いているドキュメントにはスクリプトが届かないので、タブが
+        # 表示されたときに一度だけスタイルを足し引きする
+        if not isinstance(web_view, QWebEngineView) or web_view.property("darkModeGeneration") == self.generation:
+            return
+        web_view.setProperty("darkModeGeneration", self.generation)
+        page = web_view.page()
+        dark = self.dark_mode_enabled and not self.is_excluded(web_view.url().toString())
+        page.setBackgroundColor(QColor("#121212") if dark else Qt.white)
+        page.runJavaScript(style_removal_js(DARK_MODE_STYLE_ID), QWebEngineScript.ApplicationWorld)
+        if dark:
+            page.runJavaScript(style_injection_js(DARK_MODE_STYLE_ID, DARK_MODE_CSS), QWebEngineScript.ApplicationWorld)
 
-    def remove_dark_mode_js(self, web_view):
-        js_code = """
-        document.body.style.backgroundColor = 'white';
-        document.body.style.color = 'black';
-        """
-        web_view.page().runJavaScript(js_code)
+    def prepare(self, web_view):
+        # 新しいビューはプロファイルのスクリプトで最初から揃っている。背景色だけ合わせて
+        # 白いちらつきを防ぐ
+        web_view.setProperty("darkModeGeneration", self.generation)
+        if self.dark_mode_enabled:
+            web_view.page().setBackgroundColor(QColor("#121212"))
 
 
 class SettingsDialog(QDialog):
-    def __init__(self, parent, memory_saver, dark_mode, language):
+    def __init__(self, parent, memory_saver, dark_mode, language, profile):
         super().__init__(parent)
         self.setWindowTitle("設定")
         self.language = language
         self.memory_saver = memory_saver
         self.dark_mode = dark_mode
+        self.profile = profile
         self.init_ui()
     
     def init_ui(self):
@@ -488,6 +4303,15 @@ class SettingsDialog(QDialog):
         layout.addLayout(dark_mode_layout)
         self.dark_mode_toggle.setChecked(self.dark_mode.dark_mode_enabled)
 
+        dark_mode_exclusions_layout = QHBoxLayout()
+        self.dark_mode_exclusions_label = QLabel("ダークモードを使わないサイト")
+        self.dark_mode_exclusions = QLineEdit(", ".join(sorted(self.dark_mode.excluded_sites)))
+        self.dark_mode_exclusions.setPlaceholderText("example.com, example.org")
+        self.dark_mode_exclusions.editingFinished.connect(lambda: self.dark_mode.set_excluded_sites(self.dark_mode_exclusions.text()))
+        dark_mode_exclusions_layout.addWidget(self.dark_mode_exclusions_label)
+        dark_mode_exclusions_layout.addWidget(self.dark_mode_exclusions)
+        layout.addLayout(dark_mode_exclusions_layout)
+
         # メモリーセイバーのトグルボタン
         memory_saver_layout = QHBoxLayout()
         memory_saver_toggle = QLabel("メモリーセイバー")
@@ -499,6 +4323,28 @@ class SettingsDialog(QDialog):
         layout.addLayout(memory_saver_layout)
         self.memory_saver_toggle.setChecked(self.memory_saver.memory_saver_enabled)
 
+        memory_budget_layout = QHBoxLayout()
+        self.memory_budget_label = QLabel("メモリー上限 (MB)")
+        self.memory_budget_spin = QSpinBox()
+        self.memory_budget_spin.setRange(256, 65536)
+        self.memory_budget_spin.setSingleStep(256)
+        self.memory_budget_spin.setValue(self.memory_saver.memory_budget_mb)
+        self.memory_budget_spin.valueChanged.connect(lambda value: setattr(self.memory_saver, "memory_budget_mb", value))
+        memory_budget_layout.addWidget(self.memory_budget_label)
+        memory_budget_layout.addWidget(self.memory_budget_spin)
+        layout.addLayout(memory_budget_layout)
+
+        http_cache_layout = QHBoxLayout()
+        self.http_cache_label = QLabel("ディスクキャッシュ (MB)")
+        self.http_cache_spin = QSpinBox()
+        self.http_cache_spin.setRange(16, 8192)
+        self.http_cache_spin.setSingleStep(64)
+        self.http_cache_spin.setValue(self.profile.httpCacheMaximumSize() // (1024 * 1024))
+        self.http_cache_spin.valueChanged.connect(lambda value: self.profile.setHttpCacheMaximumSize(value * 1024 * 1024))
+        http_cache_layout.addWidget(self.http_cache_label)
+        http_cache_layout.addWidget(self.http_cache_spin)
+        layout.addLayout(http_cache_layout)
+
         language_layout = QHBoxLayout()
         language_label = QLabel("言語設定")
         self.language_toggle = QComboBox()
@@ -526,23 +4372,75 @@ class SettingsDialog(QDialog):
             self.about_text.setText("Orb Browserは、Python と Qt を使って作られた軽量なブラウザです")
             self.setWindowTitle("設定")
             self.dark_mode_toggle.setText("ダークモード")
+            self.dark_mode_exclusions_label.setText("ダークモードを使わないサイト")
             self.memory_saver_toggle.setText("メモリーセイバー")
+            self.memory_budget_label.setText("メモリー上限 (MB)")
+            self.http_cache_label.setText("ディスクキャッシュ (MB)")
         elif language == "English":
             self.about_label.setText("About Orb Browser")
             self.about_text.setText("Orb Browser is a lightweight and fast web browser developed using Python and QT.")
             self.setWindowTitle("Settings")
             self.dark_mode_toggle.setText("Dark Mode")
+            self.dark_mode_exclusions_label.setText("Sites without dark mode")
             self.memory_saver_toggle.setText("Memory Saver")
+            self.memory_budget_label.setText("Memory budget (MB)")
+            self.http_cache_label.setText("Disk cache (MB)")
         elif language == "中文":
             self.about_label.setText("关于 Orb 浏览器")
             self.about_text.setText("Orb Browser 是一款使用 Python")
             self.setWindowTitle("设置")
             self.dark_mode_toggle.setText("暗模式")
+            self.dark_mode_exclusions_label.setText("不使用暗模式的网站")
             self.memory_saver_toggle.setText("内存保护器")
+            self.memory_budget_label.setText("内存上限 (MB)")
+            self.http_cache_label.setText("磁盘缓存 (MB)")
+
+def main():
+    startup_trace.mark("module body")
+    parser = argparse.ArgumentParser(prog="OrbBrowser")
+    parser.add_argument("--bench-adblock", nargs="+", metavar="LIST", help="filter list files to benchmark")
+    parser.add_argument("--corpus", help="recorded URL corpus (url<TAB>first party url<TAB>type per line)")
+    parser.add_argument("--record-urls", metavar="FILE", help="append every intercepted request to FILE")
+    parser.add_argument("--telemetry-log", metavar="FILE", help="append per-tab resource samples to FILE as JSON lines")
+    parser.add_argument("--startup-trace", nargs="?", const="-", metavar="FILE",
+                        help="print a phase-by-phase startup timing breakdown (or write it to FILE as JSON)")
+    parser.add_argument("--exit-after-startup", action="store_true", help="quit as soon as the first frame is painted")
+    parser.add_argument("--perf-trace", metavar="FILE",
+                        help="record stalls and hot-path timings and write them to FILE as Chrome trace JSON on exit")
+    parser.add_argument("--stall-threshold", type=int, default=STALL_THRESHOLD_MS, metavar="MS",
+                        help="report GUI thread stalls longer than MS (with --perf-trace)")
+    parser.add_argument("--home-url", metavar="URL", help="open URL instead of the default homepage")
+    parser.add_argument("--fulltext-indexer", metavar="DB", help=argparse.SUPPRESS)
+    args, qt_args = parser.parse_known_args()
+    if args.fulltext_indexer:
+        return run_fulltext_indexer(args.fulltext_indexer)
+    if args.bench_adblock:
+        if not args.corpus:
+            parser.error("--bench-adblock requires --corpus")
+        benchmark_filter_matching(args.bench_adblock, args.corpus)
+        return 0
+    startup_trace.output = args.startup_trace
+    startup_trace.exit_after_startup = args.exit_after_startup
+    if args.home_url:
+        MainWindow.home_url = args.home_url
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    app.setApplicationName("OrbBrowser")
+    startup_trace.mark("QApplication")
+    if args.perf_trace:
+        perf_trace.enabled = True
+        watchdog = StallWatchdog(perf_trace, args.stall_threshold)
+        app.aboutToQuit.connect(watchdog.stop)
+        app.aboutToQuit.connect(lambda: perf_trace.export(args.perf_trace))
+    window = MainWindow()
+    if args.record_urls:
+        window.adblock.interceptor.record_file = open(args.record_urls, "a", encoding="utf-8", buffering=1)
+    if args.telemetry_log:
+        window.telemetry.start_logging(args.telemetry_log)
+    window.show()
+    startup_trace.mark("show")
+    return app.exec()
+
 
-app = QApplication(sys.argv)
-app.setApplicationName("OrbBrowser")
-window = MainWindow()
-window.create_database()
-window.show()
-app.exec()
+if __name__ == "__main__":
+    sys.exit(main())
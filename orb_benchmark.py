@@ -0,0 +1,437 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import fnmatch
+import tempfile
+import threading
+import statistics
+import subprocess
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Orb Browser の性能を画面なし (QT_QPA_PLATFORM=offscreen) で測り、結果を JSON に書き出す。
+# ページとフィルターリストはローカルの HTTP サーバーから配るので、外部のネットワークには出ない。
+
+ORB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Orb Browser version1.0.py")
+FILTER_NAMES = ["easylist.txt", "easyprivacy.txt"]
+BOOKMARK_COUNTS = [10, 1000, 10000]
+OMNIBOX_HISTORY = 100000
+# 多くの履歴が共有する前方一致を1文字ずつ打つ
+OMNIBOX_TYPED = "google.com/search?q=python"
+# 比較する指標 (時間とメモリーだけ)。件数などは入力で決まるので比べない
+LOWER_IS_BETTER = [
+    "startup.cold_ms", "startup.warm_ms", "startup.cold_phases_ms.*",
+    "tabs.*.load_ms_median", "tabs.*.load_ms_p95", "tabs.*.baseline_mb", "tabs.*.loaded_mb",
+    "tabs.*.per_tab_mb", "tabs.*.rss_after_tabs_mb",
+    "filters.compile_seconds", "filters.microseconds_per_match",
+    "bookmarks.*.query_ms", "bookmarks.*.toolbar_ms", "bookmarks.*.startup_ms",
+    "omnibox.build_ms", "omnibox.keystroke_cold_max_ms", "omnibox.keystroke_cold_median_ms",
+    "omnibox.keystroke_warm_max_ms", "omnibox.title_word_ms",
+]
+HIGHER_IS_BETTER = ["filters.matches_per_second"]
+
+
+def load_orb(path=ORB_PATH):
+    spec = importlib.util.spec_from_file_location("orb_browser", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_page(n, paragraphs=200):
+    rng = random.Random(n)
+    words = ["orb", "browser", "qt", "python", "filter", "tab", "memory", "render", "page", "index"]
+    body = []
+    for i in range(paragraphs):
+        text = " ".join(rng.choice(words) for _ in range(40))
+        body.append(f"<p id='p{i}' class='text c{i % 7}'>{text}</p>")
+        if i % 25 == 0:
+            body.append(f"<div class='ad-banner ad-{i}'><img src='/ads/banner{i}.png'></div>")
+            body.append(f"<img src='/img/{n}-{i}.svg' width='64' height='64'>")
+    return (f"<!doctype html><html><head><meta charset='utf-8'><title>Page {n}</title>"
+            f"<script src='/ads/tracker.js'></script></head><body>{''.join(body)}</body></html>")
+
+
+def synthetic_filter_list(name, rules=20000):
+    rng = random.Random(name)
+    lines = [f"! Title: synthetic {name}", "/ads/banner", "||tracker.localhost^$third-party", "##.ad-banner"]
+    for i in range(rules):
+        kind = rng.random()
+        if kind < 0.5:
+            lines.append(f"||adhost{i}.example^")
+        elif kind < 0.7:
+            lines.append(f"/banner{i}/*$image,domain=site{i % 100}.localhost")
+        elif kind < 0.85:
+            lines.append(f"##.ad-{i}")
+        else:
+            lines.append(f"site{i % 100}.localhost##.promo-{i}")
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_corpus(path, urls=20000):
+    rng = random.Random(7)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(urls):
+            site = f"http://site{rng.randrange(100)}.localhost/"
+            if rng.random() < 0.3:
+                url = f"http://adhost{rng.randrange(20000)}.example/ad.js"
+            else:
+                url = f"http://cdn{rng.randrange(500)}.example/static/{rng.randrange(10 ** 6)}/app.js"
+            f.write(f"{url}\t{site}\t{rng.choice(['script', 'image', 'stylesheet', 'xmlhttprequest'])}\n")
+
+
+def synthetic_history(orb, entries=OMNIBOX_HISTORY):
+    rng = random.Random(11)
+    words = ["news", "python", "video", "the", "how", "to", "best", "review", "map", "weather"]
+    words += [f"w{i}" for i in range(3000)]
+    common = ["google.com", "youtube.com", "github.com", "en.wikipedia.org"]
+    now = time.time()
+    items = []
+    for i in range(entries):
+        domain = rng.choice(common) if rng.random() < 0.6 else f"site{rng.randrange(3000)}.com"
+        if domain == "google.com":
+            url = f"https://www.google.com/search?q={rng.choice(words)}+{i}"
+        else:
+            url = f"https://{domain}/{rng.choice(words)}/{i}"
+        title = " ".join(rng.choice(words) for _ in range(5))
+        items.append((url, title, orb.frecency_add(None, 1.0, now - rng.random() * 90 * 86400)))
+    return items
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    filter_lists = {}
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path.startswith("/page/"):
+            self.reply(200, "text/html; charset=utf-8", synthetic_page(path.rsplit("/", 1)[-1]).encode())
+        elif path.startswith("/filters/") and path[len("/filters/"):] in self.filter_lists:
+            self.reply(200, "text/plain; charset=utf-8", self.filter_lists[path[len("/filters/"):]])
+        elif path.startswith("/img/"):
+            self.reply(200, "image/svg+xml", b"<svg xmlns='http://www.w3.org/2000/svg' width='64' height='64'/>")
+        else:
+            self.reply(404, "text/plain", b"not found")
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    StandInHandler.filter_lists = {name: synthetic_filter_list(name).encode() for name in FILTER_NAMES}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def isolated_env(home):
+    # プロファイルやキャッシュが実際のホームディレクトリに書かれないようにする
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen", HOME=home,
+               XDG_DATA_HOME=os.path.join(home, "data"), XDG_CACHE_HOME=os.path.join(home, "cache"),
+               XDG_CONFIG_HOME=os.path.join(home, "config"))
+    env.setdefault("QTWEBENGINE_CHROMIUM_FLAGS", "--no-sandbox")
+    return env
+
+
+def process_tree_memory_mb(root_pid=None):
+    # 自分と子孫プロセス (レンダラー・GPU など) の PSS を合計する。PSS が読めなければ RSS を使う
+    root_pid = root_pid or os.getpid()
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rfind(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    total = 0
+    processes = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, ()))
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+            total += int(fields.get("Pss", fields.get("Rss", "0 kB")).split()[0])
+            processes += 1
+        except (OSError, ValueError):
+            continue
+    return total / 1024, processes
+
+
+def run_startup(home, repeat, base_url):
+    # 1回目は空のディレクトリからの起動 (cold)、2回目以降は同じディレクトリでの起動 (warm)
+    env = isolated_env(home)
+    totals = []
+    phases = None
+    for i in range(repeat):
+        trace_path = os.path.join(home, f"startup-{i}.json")
+        subprocess.run([sys.executable, ORB_PATH, "--startup-trace", trace_path, "--exit-after-startup",
+                        "--home-url", f"{base_url}/page/home"],
+                       cwd=home, env=env, check=True, timeout=120,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(trace_path, encoding="utf-8") as f:
+            trace = json.load(f)
+        totals.append(trace["total_ms"])
+        phases = phases or {phase["phase"]: phase["ms"] for phase in trace["phases"]}
+    return {
+        "cold_ms": totals[0],
+        "warm_ms": statistics.median(totals[1:]) if len(totals) > 1 else totals[0],
+        "cold_phases_ms": phases,
+    }
+
+
+def run_bookmarks(orb, root, base_url):
+    results = {}
+    for count in BOOKMARK_COUNTS:
+        home = os.path.join(root, f"bookmarks-{count}")
+        os.makedirs(home)
+        store = orb.BookmarkStore(os.path.join(home, "bookmarks.db"))
+        store.add_many((f"http://site{i}.localhost/page/{i}", f"Bookmark {i}") for i in range(count))
+        start = time.perf_counter()
+        store.all()
+        query_ms = (time.perf_counter() - start) * 1000
+        store.db.close()
+        startup = run_startup(home, 2, base_url)
+        results[str(count)] = {
+            "query_ms": query_ms,
+            "toolbar_ms": startup["cold_phases_ms"].get("bookmarks"),
+            "startup_ms": startup["warm_ms"],
+        }
+    return results
+
+
+def run_filters(orb, root):
+    list_paths = []
+    for name in FILTER_NAMES:
+        path = os.path.join(root, name)
+        with open(path, "wb") as f:
+            f.write(StandInHandler.filter_lists[name])
+        list_paths.append(path)
+    corpus_path = os.path.join(root, "corpus.tsv")
+    synthetic_corpus(corpus_path)
+    return orb.benchmark_filter_matching(list_paths, corpus_path)
+
+
+def run_omnibox(orb, entries=OMNIBOX_HISTORY):
+    index = orb.OmniboxIndex()
+    items = synthetic_history(orb, entries)
+    start = time.perf_counter()
+    index.add_many(items)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    def keystrokes(cold):
+        times = []
+        for n in range(1, len(OMNIBOX_TYPED) + 1):
+            if cold:
+                index.top.clear()
+            start = time.perf_counter()
+            index.query(OMNIBOX_TYPED[:n])
+            times.append((time.perf_counter() - start) * 1000)
+        return times
+
+    keystrokes(False)
+    cold = keystrokes(True)
+    warm = keystrokes(False)
+    start = time.perf_counter()
+    index.query("python")
+    title_word_ms = (time.perf_counter() - start) * 1000
+    return {
+        "build_ms": build_ms,
+        "keystroke_cold_max_ms": max(cold),
+        "keystroke_cold_median_ms": statistics.median(cold),
+        "keystroke_warm_max_ms": max(warm),
+        "title_word_ms": title_word_ms,
+    }
+
+
+def run_tabs(base_url, root, tabs, memory_saver):
+    home = os.path.join(root, f"tabs-{'on' if memory_saver else 'off'}")
+    os.makedirs(home)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", "tabs", "--base-url", base_url,
+         "--tabs", str(tabs)] + (["--memory-saver"] if memory_saver else []),
+        cwd=home, env=isolated_env(home), check=True, timeout=600, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def tabs_worker(args):
+    # 別プロセスで MainWindow を開き、タブを順に開いて読み込み時間とメモリーを測る
+    from PySide6.QtCore import QEventLoop, QTimer, QUrl
+    from PySide6.QtWidgets import QApplication
+
+    orb = load_orb()
+    orb.FILTER_LISTS[:] = [f"{args.base_url}/filters/{name}" for name in FILTER_NAMES]
+    orb.MainWindow.home_url = f"{args.base_url}/page/home"
+    port = args.base_url.rsplit(":", 1)[-1]
+    app = QApplication([sys.argv[0]])
+    window = orb.MainWindow()
+    window.show()
+
+    def wait(condition, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            loop = QEventLoop()
+            QTimer.singleShot(20, loop.quit)
+            loop.exec()
+
+    def settle(seconds):
+        wait(lambda: False, seconds)
+
+    wait(lambda: window.background_started)
+    first = window.tabs.currentWidget()
+    loaded = []
+    first.loadFinished.connect(loaded.append)
+    first.setUrl(QUrl(f"{args.base_url}/page/home"))
+    wait(lambda: loaded)
+    settle(1.0)
+    baseline_mb, _ = process_tree_memory_mb()
+
+    latencies = []
+    for i in range(args.tabs):
+        loaded = []
+        start = time.perf_counter()
+        # *.localhost は別サイトとして扱われるので、タブごとにレンダラーが分かれる
+        window.add_new_tab(QUrl(f"http://site{i}.localhost:{port}/page/{i}"), f"page {i}")
+        window.tabs.currentWidget().loadFinished.connect(
+            lambda ok, start=start, loaded=loaded: loaded.append(time.perf_counter() - start))
+        wait(lambda: loaded)
+        if loaded:
+            latencies.append(loaded[0] * 1000)
+    settle(2.0)
+    loaded_mb, processes = process_tree_memory_mb()
+
+    saver = window.memory_saver
+    if args.memory_saver:
+        saver.memory_saver_enabled = True
+        saver.freeze_after = saver.discard_after = 0
+        saver.check_inactive_tabs()
+        settle(3.0)
+    settled_mb, settled_processes = process_tree_memory_mb()
+    latencies.sort()
+    result = {
+        "tabs": args.tabs,
+        "loaded": len(latencies),
+        "load_ms_median": statistics.median(latencies) if latencies else None,
+        "load_ms_p95": latencies[int(len(latencies) * 0.95) - 1] if latencies else None,
+        "baseline_mb": baseline_mb,
+        "loaded_mb": loaded_mb,
+        "per_tab_mb": (loaded_mb - baseline_mb) / max(1, args.tabs),
+        "processes": processes,
+        "rss_after_tabs_mb": settled_mb,
+        "processes_after_tabs": settled_processes,
+    }
+    window.close()
+    app.quit()
+    print(json.dumps(result))
+
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def compare(previous, current, threshold):
+    # 前回の結果と比べ、閾値 (%) を超えて悪化した指標を返す
+    before = flatten(previous.get("results", {}))
+    after = flatten(current["results"])
+    regressions = []
+    print(f"{'metric':<48}{'before':>12}{'after':>12}{'change':>9}")
+    for name in sorted(before.keys() & after.keys()):
+        higher_is_better = any(fnmatch.fnmatchcase(name, pattern) for pattern in HIGHER_IS_BETTER)
+        if not higher_is_better and not any(fnmatch.fnmatchcase(name, pattern) for pattern in LOWER_IS_BETTER):
+            continue
+        old, new = before[name], after[name]
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = "  <-- regression" if worse > threshold else ""
+        print(f"{name:<48}{old:>12.2f}{new:>12.2f}{change:>8.1f}%{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="orb_benchmark", description="Headless performance benchmarks for Orb Browser")
+    parser.add_argument("--output", default="bench_results.json", help="write results to this JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a previous results file")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    parser.add_argument("--tabs", type=int, default=10, help="number of tabs to open")
+    parser.add_argument("--startup-runs", type=int, default=5, help="startup repetitions (first one is cold)")
+    parser.add_argument("--only", nargs="+", choices=["startup", "tabs", "filters", "bookmarks", "omnibox"],
+                        help="run only these benchmarks")
+    parser.add_argument("--worker", choices=["tabs"], help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    parser.add_argument("--memory-saver", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker == "tabs":
+        tabs_worker(args)
+        return 0
+
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    selected = set(args.only or ["startup", "tabs", "filters", "bookmarks", "omnibox"])
+    orb = load_orb()
+    server = start_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    root = tempfile.mkdtemp(prefix="orb-bench-")
+    results = {}
+    try:
+        if "startup" in selected:
+            home = os.path.join(root, "startup")
+            os.makedirs(home)
+            results["startup"] = run_startup(home, max(1, args.startup_runs), base_url)
+        if "tabs" in selected:
+            results["tabs"] = {
+                "memory_saver_off": run_tabs(base_url, root, args.tabs, False),
+                "memory_saver_on": run_tabs(base_url, root, args.tabs, True),
+            }
+        if "filters" in selected:
+            results["filters"] = run_filters(orb, root)
+        if "bookmarks" in selected:
+            results["bookmarks"] = run_bookmarks(orb, root, base_url)
+        if "omnibox" in selected:
+            results["omnibox"] = run_omnibox(orb)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        if compare(previous, report, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())